@@ -1,156 +1,109 @@
 import sys
 import threading;
 import os
-import pyaudio
-import numpy as np
-import random
-import wave
-from pydub import AudioSegment
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
-import sounddevice as sd
-import scipy.io.wavfile as wav
+from PyQt5.QtGui import *
+from engine import AudioEngine, AudioPlayer, MAX_POLYPHONY, format_stats
+from backends import AudioConfig, make_backend
+from render import render_to_file, parse_seed
+from scene import save_scene, load_scene
+from recorder import WavStreamWriter
+from importer import ImportJob, find_audio_files
+from peaks import load_peaks
+from loudness import NORMALIZE_TARGET, load_loudness
+from buffers import buffer_manager, format_memory
+from loader import pcm_cache, format_cache
 
-CHUNK = 1024
-FORMAT = pyaudio.paInt16
-CHANNELS = 2
-RATE = 44100
 OUTPUT_FILENAME = "recorded_audio.wav"
 
 # Global variables
 recording = False
-frames = []
 lastRecordingFilepath = ""
-writing = False
-playing = False
 
-class AudioPlayer(QThread):
-    def __init__(self, filename, extension):
-        super().__init__()
-        self.filename = filename
-        self.playing = False
-        self.volume = 1.0
-        self.muted = False
-        self.pan = 0.0  # 0.0 is center, -1.0 is full left, 1.0 is full right
-        self.audio_source = AudioSegment.from_file(self.filename) # the complete audio
-        self.audio = self.audio_source # the trimmed audio
-        self.duration_in_seconds = self.audio.duration_seconds
-        self.original_duration = self.duration_in_seconds
-        self.trimLeft = -1
-        self.trimRight = -1
-        self.p = pyaudio.PyAudio()
-        self.stream = None
-        self.position = 0
-        self.removed = False
-        self.looping = True
-        self.extension = extension
-        self.min_interval = -1
-        self.max_interval = -1
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.handle_timer_finish)
+# Waveform of a sound drawn from its peak pyramid, with the trimmed part highlighted.
+# The wheel zooms around the cursor, shift+wheel scrolls, dragging selects a new trim
+# and a double-click shows the whole file again.
+class WaveformView(QWidget):
+    trimSelected = pyqtSignal(float, float) # start and end in seconds
 
-    def update_trim(self):
-        if self.trimLeft > -1: # placeholder for when the audio should be untrimmed
-            self.audio = self.audio_source[self.trimLeft:self.trimRight]
-            self.duration_in_seconds = self.audio.duration_seconds
+    def __init__(self, audio_player, parent=None):
+        super().__init__(parent)
+        self.audio_player = audio_player
+        self.peaks = load_peaks(audio_player.buffer)
+        self.frames = len(audio_player.source_samples)
+        self.view_start = 0
+        self.view_end = self.frames
+        self.drag = None # Frames where a trim selection started and currently ends
+        self.trim_enabled = True
+        self.setMinimumSize(240, 48)
+        self.setToolTip("Drag to trim, scroll to zoom, shift+scroll to move, double-click to show everything")
+
+    def frame_at(self, x):
+        return int(self.view_start + (self.view_end - self.view_start) * min(max(x, 0), self.width()) / max(self.width(), 1))
+
+    def x_at(self, frame):
+        return int((frame - self.view_start) * self.width() / max(self.view_end - self.view_start, 1))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        width, height = self.width(), self.height()
+        painter.fillRect(self.rect(), QColor(32, 32, 32))
+        if self.drag:
+            start, end = sorted(self.drag)
         else:
-            self.audio = self.audio_source
-            self.duration_in_seconds = self.audio.duration_seconds
-
-    def run(self):
-        # Opens the stream
-        self.stream = self.p.open(format=self.p.get_format_from_width(self.audio.sample_width),
-                                  channels=self.audio.channels,
-                                  rate=self.audio.frame_rate,
-                                  output=True,
-                                  stream_callback=self.callback)
-        self.stream.start_stream()
-        while not self.removed and self.stream.is_active():
-            self.sleep(1)
-
-    # Runs while stream is open
-    def callback(self, in_data, frame_count, time_info, status):
-        # If not playing - returns blank data
-        if not self.playing:
-            self.position = 0
-            return (np.zeros(frame_count * self.audio.channels).tobytes(), pyaudio.paContinue)
-        
-        # Calculates the chunk size and retrieves the next chunk of audio data
-        bytes_per_frame = self.audio.sample_width * self.audio.channels
-        chunk_size = frame_count * bytes_per_frame
-        data = self.audio.raw_data[self.position:self.position + chunk_size]
-        self.position += chunk_size
-
-        # If we've reached the end of the audio, it loops back to the beginning
-        if len(data) < chunk_size:
-            if self.looping:
-                self.position = 0
-                remaining = chunk_size - len(data)
-                data += self.audio.raw_data[:remaining]
-            else:
-                self.position = 0
-                remaining = chunk_size - len(data)
-                # data += self.audio.raw_data[:remaining]
-                data += b'\x00' * remaining # Pad with silence
-                self.playing = False
-                if self.min_interval > -1:
-                    # self.timer.start(self.seconds_to_milliseconds(random.uniform(self.min_interval, self.max_interval)))
-                    randomHolder = random.uniform(self.min_interval, self.max_interval)
-                    self.timer_thread = threading.Timer(randomHolder, self.handle_timer_finish)
-                    self.timer_thread.start()
-
-        # Convert to numpy array for volume and pan adjustment
-        np_data = np.frombuffer(data, dtype=np.int16)
-        np_data = np_data.reshape(-1, 2)  # Reshape to stereo
-        np_data = np_data.astype(np.float32)
-        
-        # Apply volume
-        np_data *= self.volume
-
-        # Apply panning
-        left_factor = np.sqrt(2) / 2.0 * (np.cos(self.pan) - np.sin(self.pan))
-        right_factor = np.sqrt(2) / 2.0 * (np.cos(self.pan) + np.sin(self.pan))
-        np_data[:, 0] *= left_factor
-        np_data[:, 1] *= right_factor
-
-        # Converts the processed numpy array back to bytes
-        data = np_data.astype(np.int16).tobytes()
-
-        # If muted, return silent data but still advance pointer
-        if self.muted:
-            return (np.zeros(len(data)).tobytes(), pyaudio.paContinue)
-        
-        return (data, pyaudio.paContinue)
-
-    def toggle_play(self):
-        if hasattr(self, 'timer_thread') and self.timer_thread.is_alive(): # prevents lingering timer threads
-            self.timer_thread.cancel()
-        self.position = 0 if self.playing else self.position
-        self.playing = not self.playing
-
-    def toggle_mute(self):
-        self.muted = not self.muted
-
-    def toggle_loop(self):
-        self.looping = not self.looping
-
-    def set_volume(self, value):
-        self.volume = value / 100.0
-
-    def set_pan(self, value):
-        # Convert slider value (-100 to 100) to radians (-pi/4 to pi/4) for dB
-        self.pan = value / 100.0 * np.pi / 4
-
-    def stop(self):
-        if self.stream:
-            self.stream.stop_stream()
-            self.stream.close()
-        self.p.terminate()
-    
-    def handle_timer_finish(self):
-        global playing
-        if playing:
-            self.playing = True
+            start = self.audio_player.trim_start
+            end = start + len(self.audio_player.samples)
+        painter.fillRect(QRect(self.x_at(start), 0, self.x_at(end) - self.x_at(start), height), QColor(48, 72, 96))
+
+        # One vertical line per pixel column from its minimum to its maximum
+        mins, maxs = self.peaks.columns(self.audio_player.source_samples, self.view_start, self.view_end, width)
+        middle = height / 2
+        tops = (middle - maxs * middle).tolist()
+        bottoms = (middle - mins * middle).tolist()
+        painter.setPen(QColor(120, 200, 255))
+        painter.drawLines([QLineF(x, top, x, bottom) for x, (top, bottom) in enumerate(zip(tops, bottoms))])
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        span = self.view_end - self.view_start
+        if event.modifiers() & Qt.ShiftModifier:
+            shift = int(-steps * span / 10)
+            shift = max(-self.view_start, min(shift, self.frames - self.view_end))
+            self.view_start += shift
+            self.view_end += shift
+        else:
+            anchor = self.frame_at(event.pos().x())
+            new_span = int(min(max(span * 0.8 ** steps, min(self.width(), self.frames)), self.frames))
+            start = anchor - (anchor - self.view_start) * new_span // max(span, 1)
+            self.view_start = max(0, min(start, self.frames - new_span))
+            self.view_end = self.view_start + new_span
+        self.update()
+
+    def mouseDoubleClickEvent(self, event):
+        self.view_start = 0
+        self.view_end = self.frames
+        self.update()
+
+    def mousePressEvent(self, event):
+        if self.trim_enabled and event.button() == Qt.LeftButton:
+            frame = self.frame_at(event.pos().x())
+            self.drag = [frame, frame]
+
+    def mouseMoveEvent(self, event):
+        if self.drag:
+            self.drag[1] = self.frame_at(event.pos().x())
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if not self.drag: return
+        self.drag[1] = self.frame_at(event.pos().x())
+        start, end = sorted(self.drag)
+        self.drag = None
+        if self.x_at(end) - self.x_at(start) > 2: # Ignore plain clicks
+            rate = self.audio_player.engine.rate
+            self.trimSelected.emit(start / rate, end / rate)
+        self.update()
 
 class Sound(QWidget):
     removed = pyqtSignal(object)
@@ -162,11 +115,13 @@ class Sound(QWidget):
     # name - the name of the sound as it shows up in the list
     # filepath - the path to the file
     # extension - the extension (wav, mp3, etc)
-    def __init__(self, name, filepath, extension, parent=None):
+    # engine - the AudioEngine the sound is mixed by
+    # buffer - the decoded PcmBuffer when it was loaded in the background, None to load it here
+    def __init__(self, name, filepath, extension, engine, buffer=None, parent=None):
         super().__init__(parent)
         self.name = name
-        self.audio_player = AudioPlayer(filepath, extension)
-        self.audio_player.start()
+        self.audio_player = AudioPlayer(filepath, extension, engine, buffer)
+        engine.add_voice(self.audio_player)
         self.initUI(name)
 
     def initUI(self, name):
@@ -220,6 +175,43 @@ class Sound(QWidget):
         self.update_button.clicked.connect(self.update_interval)
         layout.addWidget(self.update_button)
 
+        # Number of overlapping one-shot voices
+        self.polyphony_label = QLabel("Voices:")
+        layout.addWidget(self.polyphony_label)
+        self.polyphony_box = QSpinBox()
+        self.polyphony_box.setRange(1, MAX_POLYPHONY)
+        self.polyphony_box.setValue(1)
+        self.polyphony_box.setToolTip("With more than one voice, the interval runs from one hit to the next so hits can overlap")
+        self.polyphony_box.valueChanged.connect(self.change_polyphony)
+        layout.addWidget(self.polyphony_box)
+
+        # Filter and reverb/delay send, for pushing a layer into the distance
+        self.filter_box = QComboBox()
+        self.filter_box.addItems(["No Filter", "Low-pass", "High-pass"])
+        self.filter_box.currentIndexChanged.connect(self.change_filter)
+        layout.addWidget(self.filter_box)
+        self.cutoff_box = QSpinBox()
+        self.cutoff_box.setRange(20, min(20000, self.audio_player.engine.rate // 2 - 1))
+        self.cutoff_box.setValue(1000)
+        self.cutoff_box.setSuffix(" Hz")
+        self.cutoff_box.setEnabled(False)
+        self.cutoff_box.valueChanged.connect(self.change_filter)
+        layout.addWidget(self.cutoff_box)
+        self.send_box = QSpinBox()
+        self.send_box.setRange(0, 100)
+        self.send_box.setSuffix("% send")
+        self.send_box.setToolTip("How much of the sound goes to the shared reverb and delay")
+        self.send_box.valueChanged.connect(self.change_send)
+        layout.addWidget(self.send_box)
+
+        # Brings the sound to a common loudness, so layers from different sources sit together
+        self.normalize_box = QCheckBox("Normalize")
+        loudness = load_loudness(self.audio_player.buffer, self.audio_player.engine.rate)
+        lufs = f"{loudness['lufs']:.1f} LUFS" if loudness['lufs'] is not None else "silent"
+        self.normalize_box.setToolTip(f"Play at {NORMALIZE_TARGET:g} LUFS (the file measures {lufs})")
+        self.normalize_box.toggled.connect(self.change_normalize)
+        layout.addWidget(self.normalize_box)
+
         # Trim info
         self.trimming_label_1 = QLabel("Trim:")
         layout.addWidget(self.trimming_label_1)
@@ -234,6 +226,9 @@ class Sound(QWidget):
         self.update_trimming_button = QPushButton('Trim')
         self.update_trimming_button.clicked.connect(self.update_trim)
         layout.addWidget(self.update_trimming_button)
+        self.waveform = WaveformView(self.audio_player)
+        self.waveform.trimSelected.connect(self.select_trim)
+        layout.addWidget(self.waveform)
 
         # Button to remove sound
         self.remove_button = QPushButton('Remove')
@@ -242,7 +237,15 @@ class Sound(QWidget):
 
         self.setLayout(layout)
 
+    # A trim dragged out on the waveform goes through the same checks as a typed one
+    def select_trim(self, start, end):
+        # Rounded down to the millisecond trims work in, so the end never passes the file
+        self.text_box3.setText(f'{int(start * 1000) / 1000:.3f}')
+        self.text_box4.setText(f'{int(end * 1000) / 1000:.3f}')
+        self.update_trim()
+
     def update_trim(self):
+        self.waveform.update()
         if (self.text_box3.text() == '' and self.text_box4.text() == ''):
             self.audio_player.trimLeft = -1
             self.audio_player.trimRight = -1
@@ -267,6 +270,48 @@ class Sound(QWidget):
             self.audio_player.max_interval = -1
             self.trimmingValueFailure.emit(self)
 
+    # Puts scene settings into the row's controls, then applies them through the usual handlers
+    def load_settings(self, settings):
+        player_settings = self.audio_player.settings()
+        player_settings.update(settings)
+        self.volume_slider.setValue(int(round(player_settings['volume'] * 100)))
+        self.pan_slider.setValue(int(round(player_settings['pan'] * 100)))
+        if player_settings['muted'] != self.audio_player.muted:
+            self.toggle_mute()
+        if player_settings['looping'] != self.audio_player.looping:
+            self.toggle_loop()
+        self.polyphony_box.setValue(int(player_settings['polyphony']))
+        self.audio_player.steal = player_settings['steal']
+        self.audio_player.set_automation(player_settings['automation'])
+        self.send_box.setValue(int(round(player_settings['send'] * 100)))
+        self.audio_player.spread = float(player_settings['spread']) # No control, but kept for Save Scene
+        # The player gets the whole filter, order included, and rejects a bad one before
+        # the controls change; they then show it with its defaults filled in
+        self.audio_player.set_filter(player_settings['filter'])
+        sound_filter = self.audio_player.filter.settings if self.audio_player.filter else None
+        for box in (self.filter_box, self.cutoff_box):
+            box.blockSignals(True)
+        try:
+            self.filter_box.setCurrentIndex([None, 'lowpass', 'highpass'].index(sound_filter['type'] if sound_filter else None))
+            if sound_filter:
+                self.cutoff_box.setValue(int(round(sound_filter['cutoff'])))
+            self.cutoff_box.setEnabled(sound_filter is not None)
+        finally:
+            for box in (self.filter_box, self.cutoff_box):
+                box.blockSignals(False)
+        self.normalize_box.blockSignals(True) # Keeps a target other than the default
+        self.normalize_box.setChecked(player_settings['normalize'] is not None)
+        self.normalize_box.blockSignals(False)
+        self.audio_player.set_normalize(player_settings['normalize'])
+        interval = player_settings['interval']
+        self.text_box1.setText(str(interval[0]) if interval else '')
+        self.text_box2.setText(str(interval[1]) if interval else '')
+        self.update_interval()
+        trim = player_settings['trim']
+        self.text_box3.setText(str(trim[0]) if trim else '')
+        self.text_box4.setText(str(trim[1]) if trim else '')
+        self.update_trim()
+
     def seconds_to_milliseconds(self, seconds):
         return int(round(seconds, 3)*1000)
 
@@ -316,21 +361,54 @@ class Sound(QWidget):
     
     def change_volume(self, value):
         self.audio_player.set_volume(value)
+
+    def change_polyphony(self, value):
+        self.audio_player.set_polyphony(value)
+
+    def change_filter(self):
+        kind = [None, 'lowpass', 'highpass'][self.filter_box.currentIndex()]
+        self.cutoff_box.setEnabled(kind is not None)
+        self.audio_player.set_filter({'type': kind, 'cutoff': self.cutoff_box.value()} if kind else None)
+
+    def change_send(self, value):
+        self.audio_player.send = value / 100.0
+
+    def change_normalize(self, checked):
+        self.audio_player.set_normalize(NORMALIZE_TARGET if checked else None)
     
     def closeEvent(self, event):
         # self.audio_player.stop()
         event.accept()
 
 class MainWindow(QMainWindow):
+    exportFinished = pyqtSignal(str)
+    exportFailed = pyqtSignal(str)
+    recordingFinished = pyqtSignal(str)
+    recordingFailed = pyqtSignal(str)
+    # Emitted from the import worker threads, delivered on the GUI thread
+    soundLoaded = pyqtSignal(int, str, object)
+    soundFailed = pyqtSignal(int, str, str)
+    importProgress = pyqtSignal(int, int)
+    importFinished = pyqtSignal(bool)
+
     def __init__(self):
         super().__init__()
         self.recording = False
-        self.pyaudio = pyaudio.PyAudio()
         self.count_label = QLabel('Current Sounds: 0')
         self.sounds = [] # List to keep track of sounds
         self.valueErrors = [] # Files with interval errors
         self.trimmingValueErrors = [] # Files with trimming errors
         self.file_path = ""
+        self.import_job = None # The running background import, if any
+        self.import_settings = None # Scene settings for each file of the running import
+        self.import_errors = [] # Files the running import could not decode
+        # Backend, device, block size and latency all come from the audio config file
+        self.audio_config = AudioConfig.load()
+        self.engine = AudioEngine(self.audio_config.rate, self.audio_config.channels, self.audio_config.block_size,
+                                  self.audio_config.speakers) # Single output stream shared by every sound
+        self.backend = make_backend(self.audio_config)
+        self.engine.start(self.backend)
+        buffer_manager.start() # Releases idle sounds' audio past the memory budget
         self.initUI()
 
     def update_count_display(self):
@@ -346,6 +424,31 @@ class MainWindow(QMainWindow):
         self.add_button.clicked.connect(self.add_sound)
         self.main_layout.addWidget(self.count_label)
         self.main_layout.addWidget(self.add_button)
+        self.add_folder_button = QPushButton('Add Folder')
+        self.add_folder_button.clicked.connect(self.add_folder)
+        self.main_layout.addWidget(self.add_folder_button)
+
+        # Progress of a background import, hidden while idle
+        self.import_bar = QProgressBar()
+        self.import_bar.setFormat("Importing %v of %m")
+        self.import_bar.hide()
+        self.main_layout.addWidget(self.import_bar)
+        self.cancel_import_button = QPushButton('Cancel Import')
+        self.cancel_import_button.clicked.connect(self.cancel_import)
+        self.cancel_import_button.hide()
+        self.main_layout.addWidget(self.cancel_import_button)
+        self.soundLoaded.connect(self.handle_sound_loaded)
+        self.soundFailed.connect(self.handle_sound_failed)
+        self.importProgress.connect(self.handle_import_progress)
+        self.importFinished.connect(self.handle_import_finished)
+
+        # Scene buttons
+        self.save_scene_button = QPushButton('Save Scene')
+        self.save_scene_button.clicked.connect(self.save_scene)
+        self.main_layout.addWidget(self.save_scene_button)
+        self.load_scene_button = QPushButton('Load Scene')
+        self.load_scene_button.clicked.connect(self.load_scene)
+        self.main_layout.addWidget(self.load_scene_button)
 
         # Play button
         self.play_button = QPushButton("Play")
@@ -361,11 +464,40 @@ class MainWindow(QMainWindow):
         self.record_button = QPushButton("Record")
         self.record_button.clicked.connect(self.handle_recording_thread)
         self.main_layout.addWidget(self.record_button)
+        self.recordingFinished.connect(self.handle_recording_finished)
+        self.recordingFailed.connect(self.handle_recording_failed)
 
-        # Export button - currently unused
+        # Export button - renders the current sounds offline to a file
         self.export_button = QPushButton("Export")
         self.export_button.clicked.connect(self.handle_exporting_thread)
-        # self.main_layout.addWidget(self.export_button)
+        self.main_layout.addWidget(self.export_button)
+        self.exportFinished.connect(self.handle_export_finished)
+        self.exportFailed.connect(self.handle_export_failed)
+
+        # Levels of the shared reverb and delay that every sound's send feeds
+        bus_layout = QHBoxLayout()
+        self.reverb_box = QSpinBox()
+        self.reverb_box.setRange(0, 100)
+        self.reverb_box.setSuffix("% reverb")
+        self.reverb_box.valueChanged.connect(lambda value: self.engine.bus.set_level('reverb', value / 100.0))
+        bus_layout.addWidget(self.reverb_box)
+        self.delay_box = QSpinBox()
+        self.delay_box.setRange(0, 100)
+        self.delay_box.setSuffix("% delay")
+        self.delay_box.valueChanged.connect(lambda value: self.engine.bus.set_level('delay', value / 100.0))
+        bus_layout.addWidget(self.delay_box)
+        self.main_layout.addLayout(bus_layout)
+
+        # Optional engine stats panel
+        self.stats_checkbox = QCheckBox("Show Engine Stats")
+        self.stats_checkbox.toggled.connect(self.toggle_stats)
+        self.main_layout.addWidget(self.stats_checkbox)
+        self.stats_label = QLabel('')
+        self.stats_label.setWordWrap(True)
+        self.stats_label.hide()
+        self.main_layout.addWidget(self.stats_label)
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.update_stats)
 
         # Label for warning about interval errors
         self.warning_label = QLabel('')
@@ -376,19 +508,19 @@ class MainWindow(QMainWindow):
         self.main_layout.addWidget(self.trimming_warning_label)
     
     def toggle_play(self):
-        global playing
-
         if self.add_button.isEnabled():
             self.add_button.setDisabled(True)
         else:
             self.add_button.setDisabled(False)
+        self.add_folder_button.setEnabled(self.add_button.isEnabled())
+        self.load_scene_button.setEnabled(self.add_button.isEnabled())
         
         if self.play_button.text() == "Play": # If currently paused
-            playing = True
+            self.engine.playing = True
             for x in self.sounds:
                 x.toggle_play()
         else: # If currently playing
-            playing = False
+            self.engine.playing = False
             for x in self.sounds:
                 if x.audio_player.playing: # Only toggle play if the audio is playing to avoid accidentally triggering inactive oneshots
                     x.toggle_play()
@@ -397,37 +529,132 @@ class MainWindow(QMainWindow):
         for x in self.sounds:
             x.looping_button.setEnabled(not x.looping_button.isEnabled())
             x.update_button.setEnabled(not x.update_button.isEnabled())
+            x.polyphony_box.setEnabled(not x.polyphony_box.isEnabled())
             x.update_trimming_button.setEnabled(not x.update_trimming_button.isEnabled())
+            x.waveform.trim_enabled = x.update_trimming_button.isEnabled()
             x.remove_button.setEnabled(not x.remove_button.isEnabled())
         self.play_button.setText("Pause" if self.play_button.text() == "Play" else "Play")
 
     def closeEvent(self, event):
-        # self.audio_player.stop()
+        self.cancel_import()
+        self.engine.stop()
         event.accept()
 
     def add_sound (self):
         global lastRecordingFilepath
 
-        file_path = ""
+        file_paths = []
         if (lastRecordingFilepath == ""):
-            file_path, _ = QFileDialog.getOpenFileName(self, "Select Sound File", "", "Audio Files (*.wav *.mp3 *.ogg *.aac *.m4a)")
+            file_paths, _ = QFileDialog.getOpenFileNames(self, "Select Sound Files", "", "Audio Files (*.wav *.mp3 *.ogg *.aac *.m4a *.flac *.aif *.aiff)")
         else:
-            file_path = lastRecordingFilepath
+            file_paths = [lastRecordingFilepath]
             lastRecordingFilepath = ""
+        if file_paths:
+            self.import_files(file_paths)
+
+    # Imports every audio file in a folder and its subfolders
+    def add_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Select Sound Folder")
+        if not folder: return
+        file_paths = find_audio_files(folder)
+        if not file_paths:
+            QMessageBox.information(self, "Add Folder", "No audio files found in " + folder)
+            return
+        self.import_files(file_paths)
+
+    # Decodes files on the import pool, each row is added as soon as its file is ready
+    # settings - optional scene settings for each file, applied to its row once added
+    def import_files(self, file_paths, settings=None):
+        self.import_settings = settings
+        self.import_errors = []
+        self.set_importing(True)
+        self.import_bar.setRange(0, len(file_paths))
+        self.import_bar.setValue(0)
+        self.import_job = ImportJob(file_paths, self.engine.rate, self.engine.source_channels,
+                                    loaded=lambda index, path, buffer: self.soundLoaded.emit(index, path, buffer),
+                                    failed=lambda index, path, error: self.soundFailed.emit(index, path, str(error)),
+                                    progress=lambda done, total: self.importProgress.emit(done, total),
+                                    finished=lambda cancelled: self.importFinished.emit(cancelled))
+        self.import_job.start()
+
+    def cancel_import(self):
+        if self.import_job:
+            self.import_job.cancel()
+            self.cancel_import_button.setDisabled(True)
+
+    # Sounds cannot be added or played while an import is running
+    def set_importing(self, importing):
+        for button in (self.add_button, self.add_folder_button, self.load_scene_button, self.play_button):
+            button.setDisabled(importing)
+        self.import_bar.setVisible(importing)
+        self.cancel_import_button.setVisible(importing)
+        self.cancel_import_button.setDisabled(False)
+
+    def handle_sound_loaded(self, index, file_path, buffer):
+        if self.import_job is None or self.import_job.cancelled.is_set(): return
+        settings = self.import_settings[index] if self.import_settings else {}
+        new_sound = self.add_sound_file(file_path, settings.get('name'), buffer)
+        if settings:
+            try:
+                new_sound.load_settings(settings)
+            except ValueError as e: # Bad automation or filter in a hand-edited scene
+                self.import_errors.append(f"{file_path}: {e}")
+
+    def handle_sound_failed(self, index, file_path, error):
+        self.import_errors.append(f"{file_path}: {error}")
+
+    def handle_import_progress(self, done, total):
+        self.import_bar.setValue(done)
+
+    def handle_import_finished(self, cancelled):
+        self.import_job = None
+        self.import_settings = None
+        self.set_importing(False)
+        if self.import_errors:
+            QMessageBox.warning(self, "Import", "Could not load:\n" + "\n".join(self.import_errors))
+        self.import_errors = []
+
+    # buffer - the decoded PcmBuffer from an import, None to decode the file now
+    def add_sound_file(self, file_path, name=None, buffer=None):
         file_name = os.path.basename(file_path)
-        name, extension = os.path.splitext(file_name)
+        base_name, extension = os.path.splitext(file_name)
         extension = extension[1:]
 
-        if file_path:
-            new_sound = Sound(name, file_path, extension)
-            new_sound.removed.connect(self.remove_sound)
-            new_sound.valueFailure.connect(self.handle_value_error)
-            new_sound.valueSuccess.connect(self.handle_value_success)
-            new_sound.trimmingValueFailure.connect(self.handle_trimming_value_error)
-            new_sound.trimmingValueSuccess.connect(self.handle_trimming_value_success)
-            self.main_layout.addWidget(new_sound)
-            self.sounds.append(new_sound)
-            self.update_count_display()
+        new_sound = Sound(name or base_name, file_path, extension, self.engine, buffer)
+        new_sound.removed.connect(self.remove_sound)
+        new_sound.valueFailure.connect(self.handle_value_error)
+        new_sound.valueSuccess.connect(self.handle_value_success)
+        new_sound.trimmingValueFailure.connect(self.handle_trimming_value_error)
+        new_sound.trimmingValueSuccess.connect(self.handle_trimming_value_success)
+        self.main_layout.addWidget(new_sound)
+        self.sounds.append(new_sound)
+        self.update_count_display()
+        return new_sound
+
+    def save_scene(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Scene", "", "Scene Files (*.json)")
+        if not file_path: return
+        save_scene(file_path, [x.audio_player for x in self.sounds], [x.name for x in self.sounds], self.engine.bus.settings())
+
+    # Replaces the current sounds with the ones in a scene file
+    def load_scene(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Load Scene", "", "Scene Files (*.json)")
+        if not file_path: return
+        try:
+            scene = load_scene(file_path)
+            self.engine.bus.configure(scene['bus'])
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Load Scene", f"Could not load the scene: {e}")
+            return
+        bus = self.engine.bus.settings()
+        for box, name in ((self.reverb_box, 'reverb'), (self.delay_box, 'delay')):
+            box.blockSignals(True) # Keeps the loaded effect settings instead of resetting them
+            box.setValue(int(round(bus[name]['level'] * 100)) if name in bus else 0)
+            box.blockSignals(False)
+        for x in list(self.sounds):
+            x.remove_self()
+        # Missing or undecodable files are reported when the import finishes
+        self.import_files([x['file'] for x in scene['sounds']], scene['sounds'])
 
     def handle_trimming_value_error(self, sound):
         if not sound in self.trimmingValueErrors:
@@ -475,6 +702,18 @@ class MainWindow(QMainWindow):
             newText = newText + ". Values must be entered as floats and the max interval must be greater than the min interval."
             self.warning_label.setText(newText)
 
+    def toggle_stats(self, checked):
+        self.stats_label.setVisible(checked)
+        if checked:
+            self.update_stats()
+            self.stats_timer.start(500)
+        else:
+            self.stats_timer.stop()
+
+    def update_stats(self):
+        self.stats_label.setText(format_stats(self.engine.stats.snapshot()) + "\n" + format_memory(buffer_manager.stats()) +
+                                 "\n" + format_cache(pcm_cache.stats()))
+
     def remove_sound(self, sound):
         if (sound in self.sounds):
             self.sounds.remove(sound)
@@ -486,13 +725,11 @@ class MainWindow(QMainWindow):
                 x.toggle_mute()
 
     def handle_recording_thread(self):
-        global recording, frames, lastRecordingFilepath, writing
+        global recording
         if self.record_button.text() == "Record": # Not currently recording
-            # threading.Thread(target=self.record).start()
             self.file_path, _ = QFileDialog.getSaveFileName(window, "Recorded Audio", "", "WAV Files (*.wav)")
             if not self.file_path: return
             recording = True
-            frames = []
             self.record_button.setText("Stop Recording")
             self.add_button.setDisabled(True)
             self.mute_button.setDisabled(True)
@@ -500,60 +737,98 @@ class MainWindow(QMainWindow):
             if self.play_button.text() == "Pause":
                 self.toggle_play()
                 self.add_button.setDisabled(True)
-            threading.Thread(target=self.record_audio).start()
+            threading.Thread(target=self.record_audio, args=(self.file_path,)).start()
         elif self.record_button.text() == "Stop Recording":
             recording = False
-            writing = True
-            self.record_button.setText("Record")
-            lastRecordingFilepath = self.file_path
-            self.add_button.setDisabled(False)
+            self.record_button.setText("Saving...")
+            self.record_button.setDisabled(True) # Until the writer has flushed the file
+            self.add_button.setDisabled(self.import_job is not None)
             self.mute_button.setDisabled(False)
-            self.play_button.setDisabled(False)
-            while writing:
-                1 + 1 # Wait until the file has been written before trying to add the sound
-            self.add_sound()
-    
-    def record_audio(self):
-        global recording, frames, writing
+            self.play_button.setDisabled(self.import_job is not None)
 
-        p = pyaudio.PyAudio()
+    # Runs on its own thread, handing each chunk straight to the disk writer
+    def record_audio(self, file_path):
+        global recording
 
-        stream = p.open(format=FORMAT,
-                        channels=CHANNELS,
-                        rate=RATE,
-                        input=True,
-                        frames_per_buffer=CHUNK)
-        
+        config = self.audio_config
+        try:
+            stream = self.backend.open_input(config.channels, config.rate, config.block_size)
+        except Exception as e: # No input device, or it is in use
+            recording = False
+            self.recordingFailed.emit(str(e))
+            return
+        try:
+            writer = WavStreamWriter(file_path, config.channels, config.rate)
+        except OSError as e:
+            recording = False
+            stream.close()
+            self.recordingFailed.emit(str(e))
+            return
+
+        try:
+            while recording and writer.error is None:
+                writer.write(stream.read(config.block_size))
+        finally:
+            stream.close()
+            writer.close()
+            writer.wait()
+            if writer.error is not None:
+                recording = False
+                self.recordingFailed.emit(str(writer.error))
+            else:
+                self.recordingFinished.emit(file_path)
+
+    # Adds the finished recording as a sound once the file is complete
+    def handle_recording_finished(self, file_path):
+        global lastRecordingFilepath
+        self.record_button.setText("Record")
+        self.record_button.setDisabled(False)
+        lastRecordingFilepath = file_path
+        if self.import_job is None: # Otherwise the next Add Sound picks the recording up
+            self.add_sound()
+
+    # Gives the controls back when the input or the file could not be opened or written
+    def handle_recording_failed(self, error):
+        self.record_button.setText("Record")
+        self.record_button.setDisabled(False)
+        self.add_button.setDisabled(self.import_job is not None)
+        self.mute_button.setDisabled(False)
+        self.play_button.setDisabled(self.import_job is not None)
+        QMessageBox.warning(self, "Record", f"Could not record: {error}")
 
-        while recording:
-            data = stream.read(CHUNK)
-            frames.append(data)
-
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-
-        wf = wave.open(self.file_path, 'wb')
-        wf.setnchannels(CHANNELS)
-        wf.setsampwidth(p.get_sample_size(FORMAT))
-        wf.setframerate(RATE)
-        wf.writeframes(b''.join(frames))
-        wf.close()
-        writing = False
-    
     def handle_exporting_thread(self):
-        self.toggle_play()
-        duration = 10
-        print("Recording system")
-        recording = sd.rec(int(duration * RATE), samplerate=RATE, channels=CHANNELS)
-        sd.wait()
-        normalized = np.int16(recording * 32767)
-        file_path, _ = QFileDialog.getSaveFileName(self, "Exported Audio", "", "WAV Files (*.wav)")
-        wav.write(file_path, RATE, normalized)
-        print("Recording saved")
+        file_path, _ = QFileDialog.getSaveFileName(self, "Exported Audio", "", "WAV Files (*.wav);;FLAC Files (*.flac)")
+        if not file_path: return
+        duration, ok = QInputDialog.getDouble(self, "Export", "Duration in seconds:", 60, 1, 86400, 1)
+        if not ok: return
+        seed, ok = QInputDialog.getText(self, "Export", "Seed for one-shot intervals (blank for random):")
+        if not ok: return
+        seed = parse_seed(seed) # Any text works as a seed
+        players = [x.audio_player for x in self.sounds]
+        self.export_button.setText("Exporting...")
+        self.export_button.setDisabled(True)
+        threading.Thread(target=self.export_audio, args=(players, file_path, duration, seed, self.engine.bus.settings())).start()
+
+    def export_audio(self, players, file_path, duration, seed, bus):
+        try:
+            # In the live speaker layout, so an export of a ring installation keeps every channel
+            render_to_file(players, file_path, duration, seed, self.engine.rate, self.engine.channels, bus=bus,
+                           speakers=self.engine.speakers)
+        except Exception as e: # An unwritable path, or a format libsndfile cannot write 16-bit
+            self.exportFailed.emit(str(e))
+        else:
+            self.exportFinished.emit(file_path)
+
+    def handle_export_finished(self, file_path):
+        self.export_button.setText("Export")
+        self.export_button.setDisabled(False)
+
+    def handle_export_failed(self, error):
+        self.handle_export_finished(None)
+        QMessageBox.warning(self, "Export", f"Could not export: {error}")
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
-    sys.exit(app.exec_())
\ No newline at end of file
+    sys.exit(app.exec_())
\ No newline at end of file
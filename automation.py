@@ -0,0 +1,137 @@
+import math
+import numpy as np
+
+ENVELOPE_BLOCKS = 64 # Blocks of modulator values computed per vectorized refill
+
+# Slow parameter changes for a sound, described in scene files as a list of modulators:
+#   {"type": "fade", "target": "gain", "from": 0, "to": 1, "seconds": 30, "delay": 0}
+#   {"type": "lfo", "target": "pan", "rate": 0.05, "depth": 0.8, "phase": 0}
+#   {"type": "walk", "target": "gain", "rate": 0.1, "low": 0.3, "high": 1}
+# Times count from when the sound starts playing. Gain modulators multiply the volume,
+# pan modulators add to the pan (-1..1). An lfo on gain dips the volume by up to depth,
+# a walk wanders between low and high, moving about rate per square root of a second.
+
+class Fade:
+    def __init__(self, target, start=0.0, end=1.0, seconds=1.0, delay=0.0):
+        if seconds <= 0:
+            raise ValueError("a fade needs a positive length in seconds")
+        self.target = target
+        self.start = float(start)
+        self.end = float(end)
+        self.seconds = float(seconds)
+        self.delay = float(delay)
+
+    def values(self, times, rng):
+        progress = np.clip((times - self.delay) / self.seconds, 0.0, 1.0)
+        return self.start + (self.end - self.start) * progress
+
+    def restart(self):
+        pass
+
+class Lfo:
+    def __init__(self, target, rate=0.1, depth=1.0, phase=0.0):
+        self.target = target
+        self.rate = float(rate)
+        self.depth = float(depth)
+        self.phase = float(phase)
+
+    def values(self, times, rng):
+        wave = np.sin(2 * np.pi * (self.rate * times + self.phase))
+        if self.target == 'gain':
+            return 1.0 - self.depth * (0.5 + 0.5 * wave)
+        return self.depth * wave
+
+    def restart(self):
+        pass
+
+# A random walk reflected off low and high. Steps come from the engine's random source,
+# so seeded renders repeat exactly.
+class RandomWalk:
+    def __init__(self, target, rate=0.1, low=0.0, high=1.0, start=None):
+        if high <= low:
+            raise ValueError("a walk needs high above low")
+        self.target = target
+        self.rate = float(rate)
+        self.low = float(low)
+        self.high = float(high)
+        self.start = (self.low + self.high) / 2 if start is None else float(start)
+        self.restart()
+
+    def values(self, times, rng):
+        step = times[1] - times[0] if len(times) > 1 else times[0] # Blocks are evenly spaced
+        steps = np.random.default_rng(rng.getrandbits(64)).standard_normal(len(times)) * (np.sqrt(step) * self.rate)
+        walk = self.value + np.cumsum(steps)
+        span = self.high - self.low
+        folded = np.remainder(walk - self.low, 2 * span) # Reflecting at both ends folds the walk
+        walk = self.low + np.where(folded > span, 2 * span - folded, folded)
+        self.value = walk[-1]
+        return walk
+
+    def restart(self):
+        self.value = self.start
+
+MODULATORS = {'fade': (Fade, {'from': 'start', 'to': 'end', 'seconds': 'seconds', 'delay': 'delay'}),
+              'lfo': (Lfo, {'rate': 'rate', 'depth': 'depth', 'phase': 'phase'}),
+              'walk': (RandomWalk, {'rate': 'rate', 'low': 'low', 'high': 'high', 'start': 'start'})}
+
+def make_modulator(settings):
+    kind = settings.get('type')
+    if kind not in MODULATORS:
+        raise ValueError(f"unknown automation type {kind!r}, expected one of {', '.join(MODULATORS)}")
+    target = settings.get('target', 'gain')
+    if target not in ('gain', 'pan'):
+        raise ValueError(f"automation target must be gain or pan, not {target!r}")
+    cls, names = MODULATORS[kind]
+    unknown = set(settings) - set(names) - {'type', 'target'}
+    if unknown:
+        raise ValueError(f"{kind} automation has unknown settings: {', '.join(sorted(unknown))}")
+    return cls(target, **{names[key]: float(value) for key, value in settings.items() if key in names})
+
+# Every modulator of one sound. Values for the next ENVELOPE_BLOCKS blocks are computed
+# at once as arrays, then handed out one block at a time from the mixing thread.
+class Automation:
+    # settings - the list of modulator dicts as stored in scene files
+    def __init__(self, settings, rate):
+        self.settings = [dict(x) for x in settings]
+        self.modulators = [make_modulator(x) for x in self.settings]
+        self.rate = rate
+        self.gain = np.ones(ENVELOPE_BLOCKS)
+        self.pan = np.zeros(ENVELOPE_BLOCKS)
+        self.restart()
+
+    # Back to time zero, when the sound starts playing again
+    def restart(self):
+        self.elapsed = 0 # Frames handed out since the start
+        self.position = ENVELOPE_BLOCKS # Next block within the computed values
+        self.block = 0 # Block size the values were computed for
+        for modulator in self.modulators:
+            modulator.restart()
+
+    # Gain multiplier and pan offset at the end of the next block of frame_count frames
+    def next(self, frame_count, rng):
+        if not self.modulators:
+            return 1.0, 0.0
+        if self.position >= ENVELOPE_BLOCKS or frame_count != self.block:
+            self.refill(frame_count, rng)
+        gain = self.gain[self.position]
+        pan = self.pan[self.position]
+        self.position += 1
+        self.elapsed += frame_count
+        return float(gain), float(pan)
+
+    def refill(self, frame_count, rng):
+        times = (self.elapsed + frame_count * np.arange(1, ENVELOPE_BLOCKS + 1)) / self.rate
+        self.gain.fill(1.0)
+        self.pan.fill(0.0)
+        for modulator in self.modulators:
+            if modulator.target == 'gain':
+                self.gain *= modulator.values(times, rng)
+            else:
+                self.pan += modulator.values(times, rng)
+        self.position = 0
+        self.block = frame_count
+
+# Coefficient of a one-pole smoother stepped once per block of frame_count frames,
+# reaching about 63% of a change in seconds
+def smoothing_coefficient(frame_count, rate, seconds):
+    return 1.0 - math.exp(-frame_count / (seconds * rate))
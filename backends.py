@@ -0,0 +1,259 @@
+import json
+import os
+import threading
+import time
+from engine import CHUNK, CHANNELS, RATE, PA_OUTPUT_UNDERFLOW, PA_OUTPUT_OVERFLOW
+
+CONFIG_PATH = os.environ.get('SOUNDSCAPE_AUDIO_CONFIG',
+                             os.path.join(os.path.expanduser('~'), '.config', 'soundscape-architect', 'audio.json'))
+
+# Every audio device setting in one place: which backend, device, block size and latency.
+# Small blocks and low latency suit live rigs, large blocks are cheaper on installation boxes.
+#   backend - 'pyaudio', 'sounddevice', 'null' (no hardware) or 'file'
+#   device, input_device - device index or (part of) its name, None for the system default
+#   latency - None for the backend default, 'low', 'high' or seconds (sounddevice only)
+#   realtime - whether the null and file backends pace blocks like a sound card would
+#   output_file - where the file backend writes
+#   channels, speakers - output channel count and, for more than two, the azimuth in degrees
+#                        of each speaker (0 ahead, clockwise), None for an even ring
+class AudioConfig:
+    KEYS = ('backend', 'rate', 'channels', 'block_size', 'device', 'input_device', 'latency', 'realtime', 'output_file',
+            'speakers')
+
+    def __init__(self, backend='pyaudio', rate=RATE, channels=CHANNELS, block_size=CHUNK, device=None,
+                 input_device=None, latency=None, realtime=True, output_file=None, speakers=None):
+        self.backend = backend
+        self.rate = rate
+        self.channels = channels
+        self.block_size = block_size
+        self.device = device
+        self.input_device = input_device
+        self.latency = latency
+        self.realtime = realtime
+        self.output_file = output_file
+        self.speakers = speakers
+
+    # Reads a JSON config, missing files and keys fall back to the defaults
+    @classmethod
+    def load(cls, path=CONFIG_PATH):
+        if not path or not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            values = json.load(f)
+        unknown = set(values) - set(cls.KEYS)
+        if unknown:
+            raise ValueError(f"{path} has unknown audio settings: {', '.join(sorted(unknown))}")
+        return cls(**values)
+
+# Output through PortAudio via PyAudio. PyAudio has no latency setting, block_size is the knob.
+class PyAudioBackend:
+    def __init__(self, config):
+        self.config = config
+        self.p = None
+        self.stream = None
+
+    def pyaudio(self):
+        import pyaudio
+        if self.p is None:
+            self.p = pyaudio.PyAudio()
+        return pyaudio
+
+    def device_index(self, device, output):
+        if device is None or isinstance(device, int):
+            return device
+        for i in range(self.p.get_device_count()):
+            info = self.p.get_device_info_by_index(i)
+            channels = info['maxOutputChannels'] if output else info['maxInputChannels']
+            if channels > 0 and str(device).lower() in info['name'].lower():
+                return i
+        raise ValueError(f"no audio device matching {device!r}")
+
+    def open_output(self, engine):
+        pyaudio = self.pyaudio()
+
+        def callback(in_data, frame_count, time_info, status):
+            latency = time_info['output_buffer_dac_time'] - time_info['current_time'] if time_info else None
+            # tobytes() is the one copy PyAudio requires
+            return (engine.process(frame_count, status, latency).tobytes(), pyaudio.paContinue)
+
+        self.stream = self.p.open(format=pyaudio.paInt16,
+                                  channels=engine.channels,
+                                  rate=engine.rate,
+                                  output=True,
+                                  frames_per_buffer=self.config.block_size,
+                                  output_device_index=self.device_index(self.config.device, True),
+                                  stream_callback=callback)
+        self.stream.start_stream()
+
+    # A blocking int16 input stream with read(frames) -> bytes and close()
+    def open_input(self, channels, rate, block_size):
+        pyaudio = self.pyaudio()
+        stream = self.p.open(format=pyaudio.paInt16,
+                             channels=channels,
+                             rate=rate,
+                             input=True,
+                             frames_per_buffer=block_size,
+                             input_device_index=self.device_index(self.config.input_device, False))
+        return PyAudioInput(stream)
+
+    def close(self):
+        if self.stream:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.p:
+            self.p.terminate()
+            self.p = None
+
+class PyAudioInput:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, frames):
+        return self.stream.read(frames, exception_on_overflow=False)
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+
+# Output through PortAudio via sounddevice, which also takes a latency target
+class SoundDeviceBackend:
+    def __init__(self, config):
+        self.config = config
+        self.stream = None
+
+    def open_output(self, engine):
+        import sounddevice as sd
+
+        def callback(outdata, frames, time_info, status):
+            flags = ((PA_OUTPUT_UNDERFLOW if status.output_underflow else 0)
+                     | (PA_OUTPUT_OVERFLOW if status.output_overflow else 0))
+            latency = time_info.outputBufferDacTime - time_info.currentTime
+            outdata[:] = engine.process(frames, flags, latency)
+
+        self.stream = sd.OutputStream(samplerate=engine.rate,
+                                      blocksize=self.config.block_size,
+                                      device=self.config.device,
+                                      channels=engine.channels,
+                                      dtype='int16',
+                                      latency=self.config.latency,
+                                      callback=callback)
+        self.stream.start()
+
+    def open_input(self, channels, rate, block_size):
+        import sounddevice as sd
+        stream = sd.RawInputStream(samplerate=rate,
+                                   blocksize=block_size,
+                                   device=self.config.input_device,
+                                   channels=channels,
+                                   dtype='int16',
+                                   latency=self.config.latency)
+        stream.start()
+        return SoundDeviceInput(stream)
+
+    def close(self):
+        if self.stream:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+class SoundDeviceInput:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, frames):
+        data, overflowed = self.stream.read(frames)
+        return bytes(data)
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+# No hardware: a thread pulls blocks from the engine and discards them, paced like a
+# sound card when config.realtime is set. Input reads return silence.
+class NullBackend:
+    def __init__(self, config):
+        self.config = config
+        self.thread = None
+        self.running = False
+
+    def open_output(self, engine):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(engine,), daemon=True)
+        self.thread.start()
+
+    def run(self, engine):
+        block_size = self.config.block_size
+        period = block_size / engine.rate
+        deadline = time.monotonic()
+        while self.running:
+            status = 0
+            if self.config.realtime:
+                deadline += period
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -period: # Fell a whole block behind, as a device would underrun
+                    status = PA_OUTPUT_UNDERFLOW
+                    deadline = time.monotonic()
+            self.write(engine.process(block_size, status, None))
+
+    def write(self, block):
+        pass
+
+    def open_input(self, channels, rate, block_size):
+        return NullInput(channels, rate, self.config.realtime)
+
+    def close(self):
+        self.running = False
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+class NullInput:
+    def __init__(self, channels, rate, realtime):
+        self.channels = channels
+        self.rate = rate
+        self.realtime = realtime
+
+    def read(self, frames):
+        if self.realtime:
+            time.sleep(frames / self.rate)
+        return bytes(frames * self.channels * 2)
+
+    def close(self):
+        pass
+
+# Like the null backend, but writes the mix to config.output_file (WAV, FLAC, ...)
+class FileBackend(NullBackend):
+    def __init__(self, config):
+        super().__init__(config)
+        if not config.output_file:
+            raise ValueError("the file backend needs output_file")
+        self.file = None
+
+    def open_output(self, engine):
+        import soundfile as sf
+        self.file = sf.SoundFile(self.config.output_file, 'w', samplerate=engine.rate,
+                                 channels=engine.channels, subtype='PCM_16')
+        super().open_output(engine)
+
+    def write(self, block):
+        self.file.write(block)
+
+    def close(self):
+        super().close()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+BACKENDS = {'pyaudio': PyAudioBackend,
+            'sounddevice': SoundDeviceBackend,
+            'null': NullBackend,
+            'file': FileBackend}
+
+def make_backend(config):
+    try:
+        return BACKENDS[config.backend](config)
+    except KeyError:
+        raise ValueError(f"unknown audio backend {config.backend!r}, expected one of {', '.join(BACKENDS)}")
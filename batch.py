@@ -0,0 +1,108 @@
+import copy
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from engine import AudioEngine, CHANNELS, CHUNK, RATE, SOURCE_CHANNELS
+from effects import SendBus
+from loader import load_buffer
+from render import render_to_file
+from scene import build_players, check_sound
+
+# Renders many variations of one scene across CPU cores.
+#
+# A sweep is a JSON object mapping parameters to lists of values, and every combination
+# becomes one variant:
+#   {"seed": [1, 2, 3],
+#    "sounds.rain.volume": [0.5, 0.8],
+#    "sounds.*.interval": [[1, 4], [4, 10]]}
+# "seed" and "duration" apply to the render, "sounds.<name, index or *>.<setting>" to
+# the sound settings used in scene files and "bus.<reverb or delay>.<setting>" to the
+# send effects.
+#
+# Sources are decoded once in the parent into the PCM cache, and every worker maps the
+# same cache files, so the decoded audio is shared through the page cache.
+
+def expand_sweep(sweep):
+    if not sweep:
+        return [{}]
+    keys = list(sweep)
+    values = [v if isinstance(v, list) else [v] for v in sweep.values()]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+# Returns a copy of scene with the "sounds.*" and "bus.*" overrides of a variant applied
+def apply_overrides(scene, overrides):
+    scene = copy.deepcopy(scene)
+    for key, value in overrides.items():
+        parts = key.split('.')
+        if parts[0] == 'bus':
+            if len(parts) != 3:
+                raise ValueError(f"sweep key {key} should look like bus.<effect>.<setting>")
+            scene.setdefault('bus', {}).setdefault(parts[1], {})[parts[2]] = value
+            continue
+        if parts[0] != 'sounds':
+            continue
+        if len(parts) != 3:
+            raise ValueError(f"sweep key {key} should look like sounds.<name>.<setting>")
+        target, setting = parts[1], parts[2]
+        matched = False
+        for i, sound in enumerate(scene['sounds']):
+            if target in ('*', str(i), sound.get('name')):
+                sound[setting] = value
+                matched = True
+        if not matched:
+            raise ValueError(f"sweep key {key} does not match any sound in the scene")
+    for sound in scene['sounds']:
+        check_sound(sound)
+    return scene
+
+worker_buffers = {} # Per worker process, file path to its mapped PcmBuffer
+
+def render_variant(scene, overrides, path, duration, seed, rate, channels, chunk, speakers):
+    engine = AudioEngine(rate, channels, chunk, speakers)
+    for sound in scene['sounds']:
+        if sound['file'] not in worker_buffers:
+            worker_buffers[sound['file']] = load_buffer(sound['file'], engine.rate, engine.source_channels)
+    scene = apply_overrides(scene, overrides)
+    players = build_players(scene, engine, worker_buffers)
+    render_to_file(players, path, duration, seed, rate, channels, chunk, bus=scene.get('bus'), speakers=speakers)
+    return path
+
+# Renders every variant of sweep into out_dir and writes a manifest.json describing them.
+# count - with no seeds in the sweep, renders this many seeds (0..count-1) per combination
+# progress - optional callable given (variants done, total)
+# rate, channels, chunk, speakers - the output format and block size, as for render_to_file
+def render_batch(scene, sweep, out_dir, duration, workers=None, extension='wav', count=1, name='variant', progress=None,
+                 rate=RATE, channels=CHANNELS, chunk=CHUNK, speakers=None):
+    sweep = dict(sweep)
+    if 'seed' not in sweep:
+        sweep['seed'] = list(range(count))
+    variants = expand_sweep(sweep)
+    for overrides in variants:
+        # Fail on a bad key or effect setting before starting any work
+        SendBus(rate, channels, apply_overrides(scene, overrides).get('bus'))
+
+    # Decode every source once up front, workers then only map the cache files
+    for file in {sound['file'] for sound in scene['sounds']}:
+        load_buffer(file, rate, min(channels, SOURCE_CHANNELS))
+
+    os.makedirs(out_dir, exist_ok=True)
+    width = len(str(len(variants) - 1))
+    manifest = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for i, overrides in enumerate(variants):
+            path = os.path.join(out_dir, f'{name}_{i:0{width}d}.{extension}')
+            variant_duration = float(overrides.get('duration', duration))
+            future = executor.submit(render_variant, scene, overrides, path, variant_duration, overrides['seed'],
+                                     rate, channels, chunk, speakers)
+            futures[future] = path
+            manifest.append({'file': os.path.basename(path), 'duration': variant_duration, **overrides})
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result() # Re-raises a worker's error
+            if progress:
+                progress(done, len(variants))
+
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
@@ -0,0 +1,183 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from engine import AudioEngine, AudioPlayer, CHUNK, CHANNELS, RATE
+from loader import PcmBuffer
+
+# Real-time benchmarks for the mixing path, run against a null device so no sound card
+# is needed. Prints (or writes) JSON so results can be diffed and regressions caught:
+#   python benchmark.py --output bench.json
+#   python benchmark.py --compare bench.json --tolerance 0.25
+
+# Stands in for the sound card: pulls blocks through the engine the way a backend
+# does, back to back, and times each one including the copy PyAudio makes
+class NullDevice:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def run(self, blocks):
+        times = np.empty(blocks)
+        process = self.engine.process
+        chunk = self.engine.chunk
+        for i in range(blocks):
+            started = time.perf_counter()
+            process(chunk).tobytes()
+            times[i] = time.perf_counter() - started
+        return times
+
+# An engine with voices synthetic sounds, a share of them polyphonic one-shots
+# effects - give every sound a filter and a send into the reverb and delay
+def build_engine(voices, rate=RATE, channels=CHANNELS, chunk=CHUNK, one_shots=0.5, polyphony=4, seconds=10, seed=0, effects=False):
+    engine = AudioEngine(rate, channels, chunk)
+    engine.rng.seed(seed)
+    if effects:
+        engine.bus.configure({'reverb': {'level': 0.3}, 'delay': {'level': 0.2}})
+    rng = np.random.default_rng(seed)
+    # A handful of distinct buffers so voices do not all hit the same cache lines
+    buffers = [PcmBuffer((rng.standard_normal((rate * seconds, engine.source_channels)) * 0.05).astype(np.float32))
+               for i in range(min(voices, 8))]
+    for i in range(voices):
+        player = AudioPlayer(f'bench-{i}', 'wav', engine, buffers[i % len(buffers)])
+        if i < voices * one_shots:
+            player.apply_settings({'looping': False, 'interval': [0.05, 0.5], 'trim': [0, 1], 'polyphony': polyphony})
+        if effects:
+            player.set_filter({'type': 'lowpass' if i % 2 else 'highpass', 'cutoff': 800})
+            player.send = 0.3
+        engine.add_voice(player)
+        player.toggle_play()
+    engine.playing = True
+    return engine
+
+def block_times(voices, blocks, warmup=50, **options):
+    device = NullDevice(build_engine(voices, **options))
+    device.run(warmup)
+    return device.run(blocks)
+
+def summarize(times, budget):
+    ms = times * 1000
+    return {'mean_ms': float(ms.mean()),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'p999_ms': float(np.percentile(ms, 99.9)),
+            'max_ms': float(ms.max()),
+            'load': float(times.mean() / budget), # Share of the block period spent mixing
+            'over_budget_blocks': int((times > budget).sum())}
+
+# Largest voice count whose p99 block time stays within headroom * budget
+def max_voices(budget, headroom, blocks, limit, **options):
+    def fits(voices):
+        return np.percentile(block_times(voices, blocks, **options), 99) <= budget * headroom
+    low, high = 0, 1
+    while high <= limit and fits(high):
+        low, high = high, high * 2
+    high = min(high, limit + 1)
+    while high - low > 1: # Binary search between the last fit and the first miss
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+# Transient and retained bytes allocated per block once the engine is warmed up
+def allocations(voices, blocks, **options):
+    device = NullDevice(build_engine(voices, **options))
+    device.run(50)
+    tracemalloc.start()
+    try:
+        peak = 0
+        before_all, _ = tracemalloc.get_traced_memory()
+        for i in range(blocks):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            device.run(1)
+            current, block_peak = tracemalloc.get_traced_memory()
+            peak += block_peak - before
+        after_all, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'peak_bytes_per_block': peak / blocks, 'retained_bytes_per_block': (after_all - before_all) / blocks}
+
+# Bytes held by one loaded sound: its decoded audio and its preallocated mixing scratch
+def sound_memory(seconds, polyphony, rate=RATE, channels=CHANNELS, chunk=CHUNK):
+    engine = AudioEngine(rate, channels, chunk)
+    buffer = PcmBuffer(np.zeros((rate * seconds, engine.source_channels), dtype=np.float32))
+    player = AudioPlayer('bench', 'wav', engine, buffer)
+    player.set_polyphony(polyphony)
+    pool = player.pool
+    scratch = sum(x.nbytes for x in (pool.positions, pool.offsets, pool.started, pool.active, pool.ramp,
+                                     pool.index, pool.silent, pool.past_end, pool.gathered, player.gains,
+                                     player.previous_gains, player.target_gains, player.gain_steps))
+    return {'seconds': seconds, 'polyphony': polyphony, 'decoded_bytes': buffer.nbytes, 'scratch_bytes': scratch}
+
+def run(args):
+    options = {'rate': args.rate, 'channels': args.channels, 'chunk': args.chunk, 'polyphony': args.polyphony,
+               'effects': args.effects}
+    budget = args.chunk / args.rate
+    results = {'config': {'chunk': args.chunk, 'rate': args.rate, 'budget_ms': budget * 1000, 'blocks': args.blocks,
+                          'channels': args.channels, 'headroom': args.headroom, 'polyphony': args.polyphony, 'effects': args.effects,
+                          'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine()},
+               'block_times': {},
+               'allocations': {},
+               'memory_per_sound': [sound_memory(s, args.polyphony, args.rate, args.channels, args.chunk) for s in (10, 60)]}
+    for voices in args.voices:
+        results['block_times'][str(voices)] = summarize(block_times(voices, args.blocks, **options), budget)
+        results['allocations'][str(voices)] = allocations(voices, min(args.blocks, 200), **options)
+    results['max_voices'] = max_voices(budget, args.headroom, min(args.blocks, 500), args.limit, **options)
+    return results
+
+# Metrics where a higher value is a regression, compared against a saved run
+def compare(results, baseline, tolerance):
+    regressions = []
+    for voices, summary in results['block_times'].items():
+        old = baseline.get('block_times', {}).get(voices)
+        if old:
+            for key in ('p50_ms', 'p99_ms'):
+                if summary[key] > old[key] * (1 + tolerance):
+                    regressions.append(f"{voices} voices {key}: {old[key]:.3f} -> {summary[key]:.3f}")
+    old_max = baseline.get('max_voices')
+    if old_max and results['max_voices'] < old_max * (1 - tolerance):
+        regressions.append(f"max_voices: {old_max} -> {results['max_voices']}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the real-time mixing path against a null device")
+    parser.add_argument('--voices', type=lambda x: [int(v) for v in x.split(',')], default=[1, 8, 32, 64],
+                        help="comma separated voice counts to time, default 1,8,32,64")
+    parser.add_argument('--blocks', type=int, default=2000, help="blocks timed per voice count")
+    parser.add_argument('--chunk', type=int, default=CHUNK)
+    parser.add_argument('--rate', type=int, default=RATE)
+    parser.add_argument('--channels', type=int, default=CHANNELS, help="output channels, more than two pan around a speaker ring")
+    parser.add_argument('--polyphony', type=int, default=4, help="voices per one-shot sound")
+    parser.add_argument('--effects', action='store_true', help="give every sound a filter and a reverb/delay send")
+    parser.add_argument('--headroom', type=float, default=0.5,
+                        help="share of the block period the p99 may use when searching for max voices")
+    parser.add_argument('--limit', type=int, default=1024, help="largest voice count the search tries")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    parser.add_argument('--compare', help="earlier results to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against --compare")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"regression: {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
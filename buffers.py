@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+import weakref
+
+MEMORY_BUDGET_BYTES = int(float(os.environ.get('SOUNDSCAPE_MEMORY_BUDGET_MB', 1024)) * 1024 ** 2)
+PREFETCH_SECONDS = 3.0 # Evicted buffers are read back this long before a scheduled trigger
+SWEEP_SECONDS = 0.5 # How often the manager looks for buffers to evict or read back
+
+# One decoded buffer and every player reading it. Sounds using the same file share one
+# PcmBuffer (see loader.load_buffer), so they share one entry and are evicted together.
+class BufferEntry:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.players = weakref.WeakSet()
+        self.resident = True # Freshly loaded buffers have just been read through
+        self.last_used = time.monotonic()
+
+    # Bytes the buffer holds while resident. Long files played through a window release
+    # what they have played, so only the stretch read ahead of each playhead counts.
+    def nbytes(self, players):
+        buffer = self.buffer
+        if not buffer.windowed:
+            return buffer.nbytes
+        frames = sum(int(PREFETCH_SECONDS * player.engine.rate) for player in players)
+        return min(frames * buffer.frame_bytes, buffer.nbytes)
+
+    # Only buffers mapped from the PCM cache can be dropped and read back; audio decoded
+    # without a cache lives in process memory and stays put
+    @property
+    def evictable(self):
+        return self.buffer.mapping is not None
+
+# Keeps the decoded audio of every loaded sound within a memory budget. Buffers nobody
+# will hear soon (stopped, muted and silent, or waiting longer than PREFETCH_SECONDS for
+# their next one-shot) are released least recently used first once the resident total is
+# over budget, and read back from their PCM cache mapping on a background thread before
+# they are next needed. Starting or unmuting a sound reads its buffer back straight away.
+class BufferManager:
+    def __init__(self, budget=MEMORY_BUDGET_BYTES):
+        self.budget = budget
+        self.entries = {} # id of the PcmBuffer to its BufferEntry
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.reloads = 0
+        self.thread = None
+
+    # Starts the background sweep, for live playback. Offline renders never need it.
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='buffers', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(SWEEP_SECONDS)
+            self.sweep()
+
+    def register(self, player):
+        with self.lock:
+            entry = self.entries.get(id(player.buffer))
+            if entry is None:
+                entry = self.entries[id(player.buffer)] = BufferEntry(player.buffer)
+            entry.players.add(player)
+
+    def unregister(self, player):
+        with self.lock:
+            entry = self.entries.get(id(player.buffer))
+            if entry is not None:
+                entry.players.discard(player)
+
+    # Makes sure player's buffer is resident, called when it is about to be heard
+    def acquire(self, player):
+        with self.lock:
+            entry = self.entries.get(id(player.buffer))
+            if entry is None:
+                return
+            entry.last_used = time.monotonic()
+            if not entry.resident:
+                self.reload(entry)
+
+    def sweep(self):
+        now = time.monotonic()
+        with self.lock:
+            upcoming = upcoming_players({player.engine for entry in self.entries.values() for player in entry.players})
+            resident = 0
+            idle = []
+            for key, entry in list(self.entries.items()):
+                players = list(entry.players)
+                if not players: # Every sound using it was removed
+                    del self.entries[key]
+                    continue
+                if any(player in upcoming or audible(player) for player in players):
+                    entry.last_used = now
+                    if not entry.resident:
+                        self.reload(entry)
+                elif entry.resident and entry.evictable:
+                    idle.append(entry)
+                if entry.resident:
+                    resident += entry.nbytes(players)
+            for entry in sorted(idle, key=lambda x: x.last_used):
+                if resident <= self.budget:
+                    break
+                resident -= entry.nbytes(list(entry.players))
+                self.evict(entry)
+
+    def evict(self, entry):
+        entry.buffer.release(0, len(entry.buffer.samples))
+        entry.resident = False
+        self.evictions += 1
+
+    # Long files only read back the stretch each player starts from
+    def reload(self, entry):
+        buffer = entry.buffer
+        if buffer.windowed:
+            for player in list(entry.players):
+                buffer.prefetch(player.trim_start, player.trim_start + int(PREFETCH_SECONDS * player.engine.rate))
+        else:
+            buffer.prefetch()
+        entry.resident = True
+        self.reloads += 1
+
+    def stats(self):
+        with self.lock:
+            entries = [(entry, list(entry.players)) for entry in self.entries.values()]
+            return {'budget_bytes': self.budget,
+                    'resident_bytes': sum(entry.nbytes(players) for entry, players in entries if entry.resident),
+                    'buffers': len(entries),
+                    'resident_buffers': sum(1 for entry, players in entries if entry.resident),
+                    'evictions': self.evictions,
+                    'reloads': self.reloads}
+
+buffer_manager = BufferManager()
+
+# Whether player is mixing audible samples now or is about to
+def audible(player):
+    if player.start_pending:
+        return True
+    if not player.playing:
+        return False
+    return not player.muted or player.ramping or bool(player.gains.any())
+
+# Players with a one-shot trigger due within PREFETCH_SECONDS on any of engines
+def upcoming_players(engines):
+    players = set()
+    for engine in engines:
+        horizon = engine.frame_time + int(PREFETCH_SECONDS * engine.rate)
+        for frame, count, player, generation in list(engine.scheduler.heap): # A copy, the mixing thread pushes and pops
+            if frame < horizon and generation == player.generation:
+                players.add(player)
+    return players
+
+def format_memory(stats):
+    return (f"decoded audio {stats['resident_bytes'] / 1024 ** 2:.0f} of {stats['budget_bytes'] / 1024 ** 2:.0f} MB, "
+            f"{stats['resident_buffers']} of {stats['buffers']} buffers resident, "
+            f"{stats['evictions']} evicted, {stats['reloads']} read back")
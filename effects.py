@@ -0,0 +1,375 @@
+import math
+import numpy as np
+from scipy.linalg import hadamard
+from scipy.ndimage import minimum_filter1d
+from scipy.signal import butter, sosfilt
+
+FILTER_TYPES = ('lowpass', 'highpass')
+REVERB_DELAYS = (1123, 1277, 1423, 1559, 1693, 1811, 1949, 2083) # Frames at 44.1 kHz, no common factors
+LIMITER_CEILING_DB = -1.0
+LIMITER_LOOKAHEAD = 0.005 # Seconds the master output is delayed so gain can come down before a peak
+LIMITER_HOLD = 0.02 # Seconds gain stays down after a peak before releasing
+LIMITER_RELEASE = 0.15 # Time constant of the release
+FILTER_STEP = 64 # Frames per step of a BlockFilter, longer steps mean fewer but larger matrix products
+FILTER_PLANS = 8 # Block sizes a BlockFilter keeps matrices for
+
+# A Butterworth low- or high-pass on one sound, as second-order sections whose state
+# carries across blocks so block edges are seamless
+#   settings - {"type": "lowpass" or "highpass", "cutoff": Hz, "order": 2}
+class SoundFilter:
+    def __init__(self, settings, rate, channels):
+        kind = settings.get('type')
+        if kind not in FILTER_TYPES:
+            raise ValueError(f"filter type must be one of {', '.join(FILTER_TYPES)}, not {kind!r}")
+        cutoff = float(settings.get('cutoff', 1000))
+        if not 0 < cutoff < rate / 2:
+            raise ValueError(f"filter cutoff must be between 0 and {rate / 2:g} Hz")
+        order = int(settings.get('order', 2))
+        if not 1 <= order <= 8:
+            raise ValueError("filter order must be 1 to 8")
+        self.settings = {'type': kind, 'cutoff': cutoff, 'order': order}
+        self.sos = butter(order, cutoff, btype=kind, fs=rate, output='sos')
+        self.filter = BlockFilter(self.sos, channels)
+
+    # Filters a (frames x channels) block in place
+    # again - the block covers the same frames as the last call, as when a voice that started
+    # mid-block is rendered on its own. By linearity it is filtered from rest and its final
+    # state added, which equals filtering the sum of both.
+    def process(self, block, again=False):
+        self.filter.process(block.T, block.T, again)
+
+    def reset(self):
+        self.filter.state.fill(0)
+
+# Second-order sections (as sosfilt takes them) run on whole blocks with a few matrix
+# products into preallocated arrays, as lfilter and sosfilt allocate their output every
+# call. A block is cut into FILTER_STEP-frame steps: every step's push on the filter state
+# is found at once, carried from step to step by one product with a triangular matrix of
+# state transitions, and each step's output is its input through the impulse response
+# plus the ringing of the state it starts from. The matrices come from running sosfilt on
+# impulses, so the output matches sosfilt to rounding.
+#   signals - rows filtered side by side, each with its own state
+class BlockFilter:
+    def __init__(self, sos, signals):
+        self.sos = np.atleast_2d(np.asarray(sos, dtype=np.float64))
+        self.order = 2 * len(self.sos)
+        self.signals = signals
+        self.state = np.zeros((signals, self.order))
+        self.plans = {} # Block size to its FilterPlan, the send bus alternates a couple of sizes
+
+    # Output and final state of frames of input that is silent apart from a unit impulse
+    # at frame impulse (None for none), starting from state (None for rest)
+    def run(self, frames, impulse=None, state=None):
+        data = np.zeros(frames)
+        if impulse is not None:
+            data[impulse] = 1.0
+        zi = np.zeros((len(self.sos), 2)) if state is None else state.reshape(len(self.sos), 2)
+        output, final = sosfilt(self.sos, data, zi=zi)
+        return output, final.ravel()
+
+    # Filters (signals x frames) inputs into outputs, which may be the same array
+    # again - as for SoundFilter.process
+    def process(self, inputs, outputs, again=False):
+        frames = inputs.shape[1]
+        plan = self.plans.get(frames)
+        if plan is None:
+            if len(self.plans) >= FILTER_PLANS: # A backend handing out ever-changing block sizes
+                self.plans.clear()
+            plan = self.plans[frames] = FilterPlan(self, frames)
+        signals, order, steps, step = self.signals, self.order, plan.steps, plan.step
+        padded = plan.padded
+        np.copyto(padded[:, :frames], inputs)
+        np.matmul(plan.blocks, plan.pushes, out=plan.pushed)
+        states = plan.states
+        np.matmul(plan.pushed.reshape(signals, steps * order), plan.carry, out=states)
+        if not again:
+            np.matmul(self.state, plan.start, out=plan.started)
+            states += plan.started
+        np.matmul(plan.blocks, plan.through, out=plan.filtered)
+        np.matmul(states.reshape(signals * steps, order), plan.ringing, out=plan.rung)
+        plan.filtered += plan.rung
+        last = steps - 1
+        np.matmul(states[:, last * order:], plan.tail_carry, out=plan.final)
+        np.matmul(padded[:, last * step:frames], plan.tail_pushes, out=plan.tail_pushed)
+        plan.final += plan.tail_pushed
+        if again:
+            self.state += plan.final
+        else:
+            self.state[:] = plan.final
+        np.copyto(outputs, plan.filtered.reshape(signals, steps * step)[:, :frames])
+
+# The matrices and scratch arrays a BlockFilter uses on blocks of frames
+class FilterPlan:
+    def __init__(self, block_filter, frames):
+        run = block_filter.run
+        order = block_filter.order
+        signals = block_filter.signals
+        step = min(FILTER_STEP, frames)
+        steps = -(-frames // step)
+        tail = frames - (steps - 1) * step # Frames in the last, possibly shorter, step
+        units = np.eye(order)
+        response = run(step, 0)[0]
+        self.through = np.zeros((step, step)) # Input to output within a step
+        for frame in range(step):
+            self.through[frame, frame:] = response[:step - frame]
+        self.ringing = np.array([run(step, state=unit)[0] for unit in units]) # Starting state to output
+        self.pushes = np.array([run(step, frame)[1] for frame in range(step)]) # Input to state after the step
+        transition = np.array([run(step, state=unit)[1] for unit in units]) # State to state after a step
+        powers = [np.linalg.matrix_power(transition, k) for k in range(steps)]
+        self.carry = np.zeros((steps * order, steps * order)) # Each step's push to the states of later steps
+        self.start = np.zeros((order, steps * order)) # The block's starting state to the same
+        for k in range(steps):
+            self.start[:, k * order:(k + 1) * order] = powers[k]
+            for j in range(k):
+                self.carry[j * order:(j + 1) * order, k * order:(k + 1) * order] = powers[k - 1 - j]
+        self.tail_carry = np.array([run(tail, state=unit)[1] for unit in units])
+        self.tail_pushes = np.array([run(tail, frame)[1] for frame in range(tail)])
+
+        self.padded = np.zeros((signals, steps * step)) # Input, with the frames past the block kept silent
+        self.blocks = self.padded.reshape(signals * steps, step)
+        self.filtered = np.empty((signals * steps, step))
+        self.rung = np.empty((signals * steps, step))
+        self.pushed = np.empty((signals * steps, order))
+        self.states = np.empty((signals, steps * order)) # State each step starts from
+        self.started = np.empty((signals, steps * order))
+        self.final = np.empty((signals, order))
+        self.tail_pushed = np.empty((signals, order))
+        self.steps = steps
+        self.step = step
+
+# Feedback delay network reverb: eight delay lines mixed through a Hadamard matrix,
+# each damped by a one-pole low-pass and scaled so the tail falls 60 dB in decay seconds.
+# Every line is at least as long as the chunks it is run on, so a whole chunk of line
+# output is known before any of it is written back, and each step is a few array ops
+# into scratch arrays sized for the longest chunk seen.
+class Reverb:
+    def __init__(self, rate, channels, level=0.3, decay=2.5, size=1.0, damping=0.3):
+        if decay <= 0 or size <= 0 or not 0 <= damping < 1:
+            raise ValueError("reverb needs decay and size above 0 and damping from 0 to 1")
+        self.settings = {'level': float(level), 'decay': float(decay), 'size': float(size), 'damping': float(damping)}
+        self.level = float(level)
+        self.delays = [max(int(d * size * rate / 44100), 64) for d in REVERB_DELAYS]
+        lines = len(self.delays)
+        gains = 10 ** (-3 * np.array(self.delays) / (rate * decay))
+        # The damped lines and the summed send, scaled to the mean of the channels, feed the lines
+        input_gains = np.where(np.arange(lines) % 2, -1.0, 1.0)[:, None] / np.sqrt(lines) / channels
+        self.matrix = np.hstack((hadamard(lines) / np.sqrt(lines) * gains[None, :], input_gains)).astype(np.float32)
+        self.damping = BlockFilter([[1 - damping, 0, 0, 1, -damping, 0]], lines)
+        self.rings = [np.zeros(d, dtype=np.float32) for d in self.delays] # In the mix's float32, so nothing is cast per block
+        self.positions = [0] * lines
+        # Output channel c sums every channels-th line starting at line c (mod the line count)
+        self.taps = np.zeros((lines, channels), dtype=np.float32)
+        for c in range(channels):
+            taps = np.arange(c % lines, lines, channels)
+            self.taps[taps, c] = 1 / np.sqrt(len(taps))
+        self.shortest = min(self.delays)
+        self.frames = 0
+
+    def allocate(self, frames):
+        lines, channels = self.taps.shape
+        self.outputs = np.empty((lines, frames), dtype=np.float32)
+        self.inputs = np.empty((lines + 1, frames), dtype=np.float32) # Damped lines, then the summed send
+        self.feedback = np.empty((lines, frames), dtype=np.float32)
+        self.wet = np.empty((frames, channels), dtype=np.float32)
+        self.frames = frames
+
+    # send - (frames x channels) input, frames <= shortest. Adds the wet signal into out.
+    def process(self, send, out):
+        frames = len(send)
+        if frames > self.frames:
+            self.allocate(frames)
+        outputs = self.outputs[:, :frames]
+        for i, ring in enumerate(self.rings):
+            ring_read(ring, self.positions[i], outputs[i])
+        inputs = self.inputs[:, :frames]
+        self.damping.process(outputs, inputs[:-1])
+        np.sum(send, axis=1, out=inputs[-1])
+        feedback = self.feedback[:, :frames]
+        np.matmul(self.matrix, inputs, out=feedback)
+        for i, ring in enumerate(self.rings):
+            self.positions[i] = ring_write(ring, self.positions[i], feedback[i])
+        wet = self.wet[:frames]
+        np.matmul(outputs.T, self.taps, out=wet)
+        wet *= self.level
+        out += wet
+
+# A feedback echo per channel
+class Echo:
+    def __init__(self, rate, channels, level=0.2, time=0.35, feedback=0.4):
+        if not 0.01 <= time <= 10 or not 0 <= feedback < 1:
+            raise ValueError("delay time must be 0.01 to 10 seconds and feedback from 0 to 1")
+        self.settings = {'level': float(level), 'time': float(time), 'feedback': float(feedback)}
+        self.level = float(level)
+        self.feedback = float(feedback)
+        self.shortest = int(time * rate)
+        self.ring = np.zeros((self.shortest, channels), dtype=np.float32)
+        self.position = 0
+        self.frames = 0
+
+    def allocate(self, frames):
+        self.delayed = np.empty((frames, self.ring.shape[1]), dtype=np.float32)
+        self.scratch = np.empty((frames, self.ring.shape[1]), dtype=np.float32)
+        self.frames = frames
+
+    def process(self, send, out):
+        frames = len(send)
+        if frames > self.frames:
+            self.allocate(frames)
+        delayed = ring_read(self.ring, self.position, self.delayed[:frames])
+        scratch = self.scratch[:frames]
+        np.multiply(delayed, self.feedback, out=scratch)
+        scratch += send
+        self.position = ring_write(self.ring, self.position, scratch)
+        np.multiply(delayed, self.level, out=scratch)
+        out += scratch
+
+# Fills out with the next len(out) frames of a circular buffer from position on,
+# len(out) <= len(ring), and returns it
+def ring_read(ring, position, out):
+    end = position + len(out)
+    if end <= len(ring):
+        out[:] = ring[position:end]
+    else:
+        split = len(ring) - position
+        out[:split] = ring[position:]
+        out[split:] = ring[:end - len(ring)]
+    return out
+
+# Writes data at position, wrapping, and returns the position after it
+def ring_write(ring, position, data):
+    end = position + len(data)
+    if end <= len(ring):
+        ring[position:end] = data
+    else:
+        split = len(ring) - position
+        ring[position:] = data[:split]
+        ring[:end - len(ring)] = data[split:]
+    return end % len(ring)
+
+# Reverb and delay shared by every sound. Sounds add their send into one buffer and the
+# effects run once per block on the sum, so their cost does not grow with the sound count.
+#   settings - {"reverb": {"level", "decay", "size", "damping"}, "delay": {"level", "time", "feedback"}},
+#              a missing effect is off
+class SendBus:
+    EFFECTS = {'reverb': Reverb, 'delay': Echo}
+
+    def __init__(self, rate, channels, settings=None):
+        self.rate = rate
+        self.channels = channels
+        self.configure(settings)
+
+    # Raises ValueError on bad settings, leaving the current effects running
+    def configure(self, settings):
+        settings = settings or {}
+        unknown = set(settings) - set(self.EFFECTS)
+        if unknown:
+            raise ValueError(f"unknown send effects: {', '.join(sorted(unknown))}")
+        effects = []
+        for name, cls in self.EFFECTS.items():
+            if settings.get(name):
+                try:
+                    effects.append((name, cls(self.rate, self.channels, **settings[name])))
+                except TypeError as e: # An unknown setting name
+                    raise ValueError(f"bad {name} settings: {e}")
+        self.effects = effects # Swapped whole, the mixing thread reads it once per block
+
+    def settings(self):
+        return {name: dict(effect.settings) for name, effect in self.effects}
+
+    # Changes one effect's wet level without restarting its tail. A level of 0 turns the
+    # effect off, a level for an effect that is off starts it with default settings.
+    def set_level(self, name, level):
+        for effect_name, effect in self.effects:
+            if effect_name == name and level > 0:
+                effect.level = effect.settings['level'] = float(level)
+                return
+        settings = self.settings()
+        if level > 0:
+            settings[name] = {'level': float(level)}
+        else:
+            settings.pop(name, None)
+        self.configure(settings)
+
+    @property
+    def active(self):
+        return bool(self.effects)
+
+    # Adds the wet signal of send into mix, in pieces no longer than the shortest delay line
+    def process(self, send, mix):
+        effects = self.effects
+        if not effects:
+            return
+        step = min(effect.shortest for name, effect in effects)
+        for start in range(0, len(send), step):
+            for name, effect in effects:
+                effect.process(send[start:start + step], mix[start:start + step])
+
+# Look-ahead peak limiter for the master mix. The output is delayed by the look-ahead, and
+# the gain every frame needs to stay under the ceiling is turned into a smooth gain curve
+# with whole-block operations: a trailing minimum over look-ahead + hold frames, a moving
+# average over the look-ahead that ramps into each peak (never above what it needs, as
+# every averaged minimum covers the frame being played) and a one-pole release.
+class MasterLimiter:
+    def __init__(self, rate, channels, ceiling_db=LIMITER_CEILING_DB, lookahead=LIMITER_LOOKAHEAD,
+                 hold=LIMITER_HOLD, release=LIMITER_RELEASE):
+        self.ceiling = 10 ** (ceiling_db / 20)
+        self.lookahead = max(2, int(lookahead * rate) // 2 * 2) # Even, so the minimum window has a trailing origin
+        self.window = self.lookahead + int(hold * rate) // 2 * 2
+        self.needed = np.ones(self.window + self.lookahead) # Gains needed by the latest frames
+        self.delayed = np.zeros((self.lookahead, channels), dtype=np.float32) # Output held back by the look-ahead
+        pole = math.exp(-1 / (release * rate))
+        self.release = BlockFilter([[1 - pole, 0, 0, 1, -pole, 0]], 1)
+        self.reduction = 0.0 # Largest gain reduction of the last block, 0..1
+        self.frames = 0 # Block size the scratch arrays below are sized for
+
+    # Sizes the scratch arrays for blocks of frames, carrying over the history and delayed output
+    def allocate(self, frames, channels):
+        history = len(self.needed) - self.frames
+        needed = np.ones(history + frames)
+        needed[:history] = self.needed[:history]
+        self.needed = needed
+        self.history = history
+        self.held = np.empty(history + frames)
+        self.sums = np.empty(frames + self.lookahead)
+        self.magnitudes = np.empty((frames, channels), dtype=np.float32)
+        self.peaks = np.empty(frames, dtype=np.float32)
+        self.reductions = np.empty(frames)
+        self.released = np.empty((1, frames))
+        self.gain = np.empty(frames, dtype=np.float32)
+        delayed = np.empty((frames + self.lookahead, channels), dtype=np.float32)
+        delayed[:self.lookahead] = self.delayed[:self.lookahead]
+        self.delayed = delayed
+        self.frames = frames
+
+    # Limits a (frames x channels) float32 block in place. Scratch arrays are reused from
+    # block to block, so the mixing thread allocates nothing here.
+    def process(self, mix):
+        frames, channels = mix.shape
+        if frames != self.frames:
+            self.allocate(frames, channels)
+        needed = self.needed
+        history = self.history
+        peaks = np.abs(mix, out=self.magnitudes).max(axis=1, out=self.peaks)
+        np.maximum(peaks, self.ceiling, out=peaks)
+        np.divide(self.ceiling, peaks, out=peaks)
+        np.copyto(needed[history:], peaks) # Dividing straight into float64 would buffer the cast
+        held = minimum_filter1d(needed, self.window + 1, output=self.held, origin=self.window // 2)
+        sums = np.cumsum(held[history - self.lookahead:], out=self.sums)
+        reduction = np.subtract(sums[self.lookahead:], sums[:frames], out=self.reductions)
+        reduction *= -1 / self.lookahead
+        reduction += 1
+        release = self.release
+        if release.state[0, 0] > 1e-6 or reduction.max() > 0: # Below the ceiling with nothing to release, gain is 1
+            release.process(reduction[None, :], self.released)
+            np.maximum(reduction, self.released[0], out=reduction)
+        self.reduction = float(reduction.max())
+        gain = self.gain
+        np.subtract(1, reduction, out=reduction)
+        np.copyto(gain, reduction) # Cast to the mix's float32 without a temporary
+
+        delayed = self.delayed
+        delayed[self.lookahead:] = mix
+        for channel in range(channels): # Broadcasting the gain column would make numpy buffer it
+            np.multiply(delayed[:frames, channel], gain, out=mix[:, channel])
+        delayed[:self.lookahead] = delayed[frames:]
+        needed[:history] = needed[frames:] # The newest frames become the history
@@ -0,0 +1,736 @@
+import bisect
+import heapq
+import math
+import threading
+import time
+import random
+import numpy as np
+from loader import load_buffer
+from automation import Automation, smoothing_coefficient
+from effects import MasterLimiter, SendBus, SoundFilter
+from loudness import load_loudness, normalize_gain
+from buffers import buffer_manager
+from panning import SPREAD_DEGREES, pan_matrix, ring_speakers
+
+CHUNK = 1024
+CHANNELS = 2
+SOURCE_CHANNELS = 2 # Sounds are decoded to at most this many channels, then panned onto the outputs
+RATE = 44100
+SOURCE_ROWS = 64 # Sound channels the mixing matrices start with room for, they grow as needed
+
+# PortAudio stream callback status flags (paStreamCallbackFlags)
+PA_INPUT_UNDERFLOW = 0x1
+PA_INPUT_OVERFLOW = 0x2
+PA_OUTPUT_UNDERFLOW = 0x4
+PA_OUTPUT_OVERFLOW = 0x8
+
+# Live counters for the mixing thread: a histogram of per-block processing time, deadline
+# overruns, PortAudio under/overflows, active voices, one-shot scheduling lag and how hard
+# the master limiter works. Only the
+# mixing thread writes them; snapshot() may be called from any thread and can be a block stale.
+class EngineStats:
+    BIN_EDGES_MS = [0.0625 * 2 ** (i / 2) for i in range(24)] # 0.0625 ms to 181 ms, plus one bin above
+
+    def __init__(self, rate, chunk):
+        self.rate = rate
+        self.chunk = chunk
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.BIN_EDGES_MS) + 1)
+        self.blocks = 0
+        self.frames = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_load = 0.0
+        self.overruns = 0 # Blocks that took longer to mix than they last
+        self.underruns = 0 # The device ran out of output, what is heard as a dropout
+        self.overflows = 0
+        self.input_underflows = 0
+        self.input_overflows = 0
+        self.active_voices = 0
+        self.peak_voices = 0
+        self.pending_triggers = 0
+        self.late_triggers = 0 # One-shots that started after their scheduled frame
+        self.max_lag_frames = 0
+        self.output_latency = None # Seconds from the callback to the buffer reaching the DAC
+        self.limited_blocks = 0 # Blocks the master limiter turned down
+        self.max_reduction = 0.0 # Deepest limiter gain reduction, 0..1
+        self.started = time.monotonic()
+
+    def record_block(self, seconds, frames, voices, pending):
+        self.counts[bisect.bisect_left(self.BIN_EDGES_MS, seconds * 1000)] += 1
+        self.blocks += 1
+        self.frames += frames
+        self.total_seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        self.last_load = seconds * self.rate / frames
+        if self.last_load > 1.0:
+            self.overruns += 1
+        self.active_voices = voices
+        if voices > self.peak_voices:
+            self.peak_voices = voices
+        self.pending_triggers = pending
+
+    def record_status(self, status):
+        if status & PA_OUTPUT_UNDERFLOW:
+            self.underruns += 1
+        if status & PA_OUTPUT_OVERFLOW:
+            self.overflows += 1
+        if status & PA_INPUT_UNDERFLOW:
+            self.input_underflows += 1
+        if status & PA_INPUT_OVERFLOW:
+            self.input_overflows += 1
+
+    def record_limiter(self, reduction):
+        if reduction > 1e-3:
+            self.limited_blocks += 1
+            if reduction > self.max_reduction:
+                self.max_reduction = reduction
+
+    def record_lag(self, frames):
+        self.late_triggers += 1
+        if frames > self.max_lag_frames:
+            self.max_lag_frames = frames
+
+    # Upper edge in ms of the histogram bin holding the given fraction of blocks
+    def percentile_ms(self, fraction):
+        target = fraction * self.blocks
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                edge = self.BIN_EDGES_MS[i] if i < len(self.BIN_EDGES_MS) else float('inf')
+                return min(edge, self.max_seconds * 1000)
+        return 0.0
+
+    def snapshot(self):
+        audio_seconds = self.frames / self.rate
+        return {'blocks': self.blocks,
+                'uptime_seconds': time.monotonic() - self.started,
+                'mean_ms': self.total_seconds / self.blocks * 1000 if self.blocks else 0.0,
+                'p50_ms': self.percentile_ms(0.5),
+                'p99_ms': self.percentile_ms(0.99),
+                'max_ms': self.max_seconds * 1000,
+                'budget_ms': self.chunk / self.rate * 1000,
+                'load': self.total_seconds / audio_seconds if audio_seconds else 0.0,
+                'last_load': self.last_load,
+                'overruns': self.overruns,
+                'underruns': self.underruns,
+                'overflows': self.overflows,
+                'input_underflows': self.input_underflows,
+                'input_overflows': self.input_overflows,
+                'active_voices': self.active_voices,
+                'peak_voices': self.peak_voices,
+                'pending_triggers': self.pending_triggers,
+                'late_triggers': self.late_triggers,
+                'max_lag_ms': self.max_lag_frames / self.rate * 1000,
+                'output_latency_ms': self.output_latency * 1000 if self.output_latency is not None else None,
+                'limited_blocks': self.limited_blocks,
+                'max_limiter_db': 20 * math.log10(1 - self.max_reduction) if self.max_reduction else 0.0,
+                # [upper edge in ms, blocks], the last bin has no upper edge
+                'histogram': [[edge, count] for edge, count in zip(self.BIN_EDGES_MS + [None], self.counts)]}
+
+# One line summary of a stats snapshot, for the stats panel and headless logs
+def format_stats(stats):
+    text = (f"load {stats['load'] * 100:.1f}% (last {stats['last_load'] * 100:.1f}%), "
+            f"block p50 {stats['p50_ms']:.2f} ms / p99 {stats['p99_ms']:.2f} ms / max {stats['max_ms']:.2f} ms "
+            f"of {stats['budget_ms']:.1f} ms, "
+            f"overruns {stats['overruns']}, underruns {stats['underruns']}, "
+            f"voices {stats['active_voices']} (peak {stats['peak_voices']}), "
+            f"pending one-shots {stats['pending_triggers']}, late {stats['late_triggers']} "
+            f"(max lag {stats['max_lag_ms']:.1f} ms)")
+    if stats['output_latency_ms'] is not None:
+        text += f", output latency {stats['output_latency_ms']:.1f} ms"
+    if stats['limited_blocks']:
+        text += f", limiter {stats['max_limiter_db']:.1f} dB max over {stats['limited_blocks']} blocks"
+    return text
+
+# Pending one-shot triggers, ordered by the engine frame they start on. A single heap
+# on the sample clock replaces a thread per trigger, and is only touched by the mixing thread.
+class Scheduler:
+    def __init__(self):
+        self.heap = []
+        self.count = 0 # Tie-breaker so triggers due on the same frame keep their order
+
+    def __len__(self):
+        return len(self.heap)
+
+    # generation - the voice's trigger generation when scheduled, a later cancel makes it stale
+    def schedule(self, frame, voice, generation):
+        heapq.heappush(self.heap, (frame, self.count, voice, generation))
+        self.count += 1
+
+    # Pops the next trigger due before end_frame, or None
+    def pop_due(self, end_frame):
+        while self.heap and self.heap[0][0] < end_frame:
+            frame, count, voice, generation = heapq.heappop(self.heap)
+            if generation == voice.generation:
+                return frame, voice
+        return None
+
+# Owns the one output stream and mixes every registered voice into it.
+# The stream itself comes from a backend (see backends.py) that calls process() per block.
+# Each sound sums its voices into its own columns of one sources matrix, then every sound
+# is panned onto every output channel at once by multiplying it with the gain matrix.
+#   speakers - azimuths in degrees of each output channel when there are more than two,
+#              evenly spaced around the listener by default (see panning.py)
+class AudioEngine:
+    def __init__(self, rate=RATE, channels=CHANNELS, chunk=CHUNK, speakers=None):
+        self.rate = rate
+        self.channels = channels
+        self.chunk = chunk
+        self.source_channels = min(channels, SOURCE_CHANNELS)
+        self.speakers = None
+        if channels > 2:
+            self.speakers = [float(x) for x in speakers] if speakers else ring_speakers(channels)
+            if len(self.speakers) != channels:
+                raise ValueError(f"{len(self.speakers)} speaker positions given for {channels} channels")
+        self.playing = False # Transport state, one-shots only retrigger while this is set
+        self.frame_time = 0 # Frames mixed so far, the clock one-shot intervals are measured on
+        self.rng = random.Random() # Seed it to make one-shot intervals reproducible
+        self.scheduler = Scheduler()
+        self.stats = EngineStats(rate, chunk)
+        self.voices = () # Replaced rather than mutated so the callback never needs the lock
+        self.lock = threading.Lock()
+        self.backend = None
+        self.bus = SendBus(rate, channels) # Shared reverb and delay, off until configured
+        self.bus_active = False # Whether sounds should feed send_buffer during this block
+        self.limiter = MasterLimiter(rate, channels) # Keeps the summed mix under the ceiling, None to turn off
+        # Preallocated so the steady-state callback does no per-block allocation
+        self.mix_buffer = np.zeros((chunk, channels), dtype=np.float32)
+        self.send_buffer = np.zeros((chunk, channels), dtype=np.float32)
+        self.out_buffer = np.zeros((chunk, channels), dtype=np.int16)
+        self.rows = 0 # Columns of sources claimed this block
+        self.ramping = False # Whether any claimed sound's gains glide during this block
+        self.sending = False # Whether any claimed sound feeds the send bus
+        self.allocate_rows(chunk, SOURCE_ROWS)
+
+    # The per-block mixing matrices, for frames frames and capacity sound channels
+    def allocate_rows(self, frames, capacity):
+        self.sources = np.zeros((frames, capacity), dtype=np.float32, order='F') # Column-major, so each sound's columns are contiguous
+        self.row_gains = np.zeros((capacity, self.channels), dtype=np.float32) # At the end of the block
+        self.previous_row_gains = np.zeros((capacity, self.channels), dtype=np.float32) # At its start
+        self.gain_steps = np.zeros((capacity, self.channels), dtype=np.float32)
+        self.send_gains = np.zeros((capacity, self.channels), dtype=np.float32)
+        self.row_sends = np.zeros((capacity, self.channels), dtype=np.float32) # Each row's send, repeated per output
+        # 0..1 across the block for every output, full size as broadcasting would make numpy allocate a buffer
+        self.unit_ramp = np.repeat((np.arange(1, frames + 1, dtype=np.float32) / frames)[:, None], self.channels, axis=1)
+        self.ramp_mix = np.zeros((frames, self.channels), dtype=np.float32)
+
+    # First of count columns of sources for one sound's channels in this block. The
+    # matrices double when full, which only happens as a scene grows, keeping the columns
+    # and gains already claimed.
+    def claim_rows(self, count):
+        start = self.rows
+        capacity = self.sources.shape[1]
+        if start + count > capacity:
+            sources, gains, previous, sends = self.sources, self.row_gains, self.previous_row_gains, self.row_sends
+            self.allocate_rows(len(sources), max(start + count, 2 * capacity))
+            self.sources[:, :start] = sources[:, :start]
+            self.row_gains[:start] = gains[:start]
+            self.previous_row_gains[:start] = previous[:start]
+            self.row_sends[:start] = sends[:start]
+        self.rows = start + count
+        return start
+
+    # Pans every sound onto the output channels with one matrix multiply: the sources
+    # times the gains at the start of the block, plus, while any gains glide, the sources
+    # times each gain's change ramped in across the block. The send bus input is the same
+    # product with every sound's gains scaled by its send.
+    def apply_gains(self, mix):
+        rows = self.rows
+        if rows == 0:
+            mix.fill(0)
+            return
+        sources = self.sources[:, :rows]
+        previous = self.previous_row_gains[:rows]
+        np.matmul(sources, previous, out=mix)
+        if self.ramping:
+            steps = np.subtract(self.row_gains[:rows], previous, out=self.gain_steps[:rows])
+            mix += np.multiply(np.matmul(sources, steps, out=self.ramp_mix), self.unit_ramp, out=self.ramp_mix)
+        if self.sending:
+            sends = self.row_sends[:rows]
+            np.matmul(sources, np.multiply(previous, sends, out=self.send_gains[:rows]), out=self.send_buffer)
+            if self.ramping:
+                np.multiply(steps, sends, out=steps)
+                self.send_buffer += np.multiply(np.matmul(sources, steps, out=self.ramp_mix), self.unit_ramp, out=self.ramp_mix)
+
+    # Fills out (source channels x output channels) with the gains of a sound at position -1..1
+    def pan_gains(self, volume, position, spread, out):
+        pan_matrix(volume, position, spread, self.speakers, out)
+
+    def add_voice(self, voice):
+        with self.lock:
+            if voice not in self.voices:
+                self.voices = self.voices + (voice,)
+
+    def remove_voice(self, voice):
+        with self.lock:
+            self.voices = tuple(x for x in self.voices if x is not voice)
+
+    # backend - an output backend from backends.make_backend
+    def start(self, backend):
+        self.backend = backend
+        backend.open_output(self)
+
+    def stop(self):
+        if self.backend:
+            self.backend.close()
+            self.backend = None
+
+    # Sums every voice into one float buffer, then clips and converts once.
+    # The returned int16 block is reused, so it must be consumed before the next call
+    def mix(self, frame_count):
+        started = time.perf_counter()
+        if frame_count != len(self.mix_buffer):
+            self.mix_buffer = np.zeros((frame_count, self.channels), dtype=np.float32)
+            self.send_buffer = np.zeros((frame_count, self.channels), dtype=np.float32)
+            self.out_buffer = np.zeros((frame_count, self.channels), dtype=np.int16)
+            self.allocate_rows(frame_count, self.sources.shape[1])
+        mix = self.mix_buffer
+        self.rows = 0
+        self.ramping = False
+        self.sending = False
+        self.bus_active = self.bus.active
+        # One-shots due in this block start on their exact frame, then any that came
+        # due while rendering (a hit that ended and retriggers within the block) are
+        # rendered on their own
+        self.start_due(mix)
+        for voice in self.voices:
+            voice.render(mix)
+        self.start_due(mix, render=True)
+        self.apply_gains(mix)
+        if self.bus_active: # Once for all sounds
+            if not self.sending:
+                self.send_buffer.fill(0) # Keeps the tails ringing
+            self.bus.process(self.send_buffer, mix)
+        limiter = self.limiter
+        if limiter:
+            limiter.process(mix)
+            self.stats.record_limiter(limiter.reduction)
+        self.frame_time += frame_count
+        np.clip(mix, -1.0, 1.0, out=mix)
+        np.multiply(mix, 32767, out=mix)
+        np.copyto(self.out_buffer, mix, casting='unsafe')
+        active = 0
+        for voice in self.voices:
+            if voice.playing:
+                active += voice.pool.count
+        self.stats.record_block(time.perf_counter() - started, frame_count, active, len(self.scheduler))
+        return self.out_buffer
+
+    def start_due(self, mix, render=False):
+        while True:
+            due = self.scheduler.pop_due(self.frame_time + len(mix))
+            if due is None:
+                break
+            frame, voice = due
+            if not self.playing:
+                continue
+            if frame < self.frame_time:
+                self.stats.record_lag(self.frame_time - frame)
+            slot = voice.trigger(max(frame - self.frame_time, 0))
+            if render and slot is not None:
+                voice.render(mix, slot, slot + 1)
+
+    # Called by the backend for every block while the stream is open
+    # status - PortAudio callback flags, output_latency - seconds until the block is heard
+    def process(self, frame_count, status=0, output_latency=None):
+        if status:
+            self.stats.record_status(status)
+        if output_latency is not None:
+            self.stats.output_latency = output_latency
+        return self.mix(frame_count)
+
+MAX_POLYPHONY = 32
+STEAL_MODES = ('oldest', 'none')
+SMOOTHING_SECONDS = 0.02 # Time constant of the glide to new gains, short enough to feel instant
+GAIN_EPSILON = 1e-5 # Gains closer than this to their target snap to it and stop ramping
+
+# Preallocated playheads for one sound, all reading the same sample buffer
+class VoicePool:
+    def __init__(self, size, frames, channels):
+        self.size = size
+        self.count = 0 # Slots in use, active ones are packed to the front before each block
+        self.positions = np.zeros(size, dtype=np.int64)
+        self.offsets = np.zeros(size, dtype=np.int64) # Frame within the current block a new voice starts on
+        self.started = np.zeros(size, dtype=np.int64) # Engine frame each voice started on, for stealing
+        self.active = np.zeros(size, dtype=bool)
+        self.allocate(frames, channels)
+
+    # Scratch space for mixing every voice in one pass, sized for a block
+    def allocate(self, frames, channels):
+        self.ramp = np.arange(frames, dtype=np.int64)
+        self.index = np.zeros((self.size, frames), dtype=np.int64)
+        self.silent = np.zeros((self.size, frames), dtype=bool) # Frames before a voice starts or after it ends
+        self.past_end = np.zeros((self.size, frames), dtype=bool)
+        self.gathered = np.zeros((self.size, frames, channels), dtype=np.float32)
+
+    # Packs active voices to the front so one slice covers all of them
+    def compact(self):
+        if self.active[:self.count].all():
+            return
+        keep = np.flatnonzero(self.active[:self.count])
+        n = len(keep)
+        self.positions[:n] = self.positions[keep]
+        self.offsets[:n] = self.offsets[keep]
+        self.started[:n] = self.started[keep]
+        self.active[:n] = True
+        self.active[n:] = False
+        self.count = n
+
+    # Returns a slot for a new voice, stealing one when the pool is full
+    # steal - 'oldest' to cut the longest-running voice, 'none' to skip the new one
+    def allocate_slot(self, steal):
+        if self.count < self.size:
+            self.count += 1
+            return self.count - 1
+        free = np.flatnonzero(~self.active[:self.count])
+        if len(free):
+            return int(free[0])
+        if steal == 'oldest':
+            return int(np.argmin(self.started[:self.count]))
+        return None
+
+# A single sound's playback state, mixed by the AudioEngine it is registered with.
+# Each trigger gets its own playhead from a VoicePool, so a one-shot can overlap itself.
+class AudioPlayer:
+    # buffer - an already loaded PcmBuffer to share instead of loading filename again
+    def __init__(self, filename, extension, engine, buffer=None):
+        self.filename = filename
+        self.engine = engine
+        self.playing = False
+        self.volume = 1.0
+        self.muted = False
+        self.pan = 0.0  # 0.0 is center, -1.0 is full left, 1.0 is full right; all the way round a speaker ring
+        self.spread = SPREAD_DEGREES # Degrees between a stereo sound's channels on a speaker ring
+        if buffer is None or buffer.samples.shape[1] != engine.source_channels:
+            buffer = load_buffer(self.filename, engine.rate, engine.source_channels)
+        self.buffer = buffer
+        self.source_samples = buffer.samples # the complete audio, memory-mapped when cached
+        self.samples = self.source_samples # the trimmed audio, always a view of source_samples
+        self.trim_start = 0 # Frame offset of samples within source_samples
+        self.release_mark = 0 # Position up to which played pages of a windowed buffer were released
+        self.duration_in_seconds = len(self.samples) / engine.rate
+        self.original_duration = self.duration_in_seconds
+        self.trimLeft = -1
+        self.trimRight = -1
+        self.removed = False
+        self.looping = True
+        self.extension = extension
+        self.min_interval = -1
+        self.max_interval = -1
+        self.generation = 0 # Bumped to cancel a one-shot trigger that is already scheduled
+        self.start_pending = False # Set by toggle_play, the mixing thread starts the first voice
+        # With one voice the interval runs from the end of a one-shot, with more it runs
+        # from onset to onset so hits overlap whenever it is shorter than the sound
+        self.polyphony = 1
+        self.steal = 'oldest'
+        self.pool = VoicePool(self.polyphony, engine.chunk, engine.source_channels)
+        self.automation = Automation([], engine.rate)
+        self.filter = None # SoundFilter applied to the sum of this sound's voices
+        self.send = 0.0 # Share of the sound sent to the engine's reverb/delay bus, after gain and pan
+        self.normalize = None # Target loudness in LUFS, None to play the file at its own level
+        self.normalize_gain = 1.0
+        # Gains from each source channel to each output channel, from volume, pan, mute and
+        # automation, glided at block rate
+        shape = (engine.source_channels, engine.channels)
+        self.gains = np.zeros(shape, dtype=np.float32) # at the end of this block
+        self.previous_gains = np.zeros(shape, dtype=np.float32) # at the end of the last one
+        self.target_gains = np.zeros(shape, dtype=np.float32)
+        self.gain_steps = np.zeros(shape, dtype=np.float32)
+        self.gain_key = None # (volume, pan, spread) target_gains were computed for
+        self.gain_frame = -1 # Engine frame of the block gains were last updated for
+        self.rendered_frame = -1 # Engine frame of the block every voice was last rendered for
+        self.ramping = False
+        self.smoothing_frames = engine.chunk
+        self.smoothing = smoothing_coefficient(engine.chunk, engine.rate, SMOOTHING_SECONDS)
+        buffer_manager.register(self) # Counts the buffer against the memory budget
+
+    def update_trim(self):
+        # Trims are offset/length views over the same buffer, never copies
+        if self.trimLeft > -1: # placeholder for when the audio should be untrimmed
+            start = self.trimLeft * self.engine.rate // 1000
+            end = self.trimRight * self.engine.rate // 1000
+            self.samples = self.source_samples[start:end]
+            self.trim_start = start
+        else:
+            self.samples = self.source_samples
+            self.trim_start = 0
+        self.reset_voices()
+        self.release_mark = 0
+        self.duration_in_seconds = len(self.samples) / self.engine.rate
+
+    # Swapping in a fresh pool stops every voice without racing the mixing thread
+    def reset_voices(self):
+        self.pool = VoicePool(self.polyphony, self.engine.chunk, self.engine.source_channels)
+
+    # settings - list of modulator dicts, see automation.py. Raises ValueError on bad ones.
+    def set_automation(self, settings):
+        self.automation = Automation(settings or [], self.engine.rate)
+
+    # settings - {"type": "lowpass" or "highpass", "cutoff": Hz, "order": 2}, None for no filter.
+    # Raises ValueError on bad ones.
+    def set_filter(self, settings):
+        self.filter = SoundFilter(settings, self.engine.rate, self.engine.source_channels) if settings else None
+
+    # target - loudness in LUFS to bring the sound to, None for none. Measures the file the
+    # first time, later loads read the measurement from the PCM cache.
+    def set_normalize(self, target):
+        if target is None:
+            self.normalize_gain = 1.0
+        else:
+            target = float(target)
+            self.normalize_gain = normalize_gain(load_loudness(self.buffer, self.engine.rate), target)
+        self.normalize = target
+
+    def set_polyphony(self, value):
+        self.polyphony = max(1, min(int(value), MAX_POLYPHONY))
+        self.reset_voices()
+
+    # Every user-facing parameter as plain data, the per-sound part of a scene file.
+    # pan is -1.0..1.0, interval and trim are [start, end] in seconds or None
+    def settings(self):
+        return {'file': self.filename,
+                'volume': self.volume,
+                'pan': self.pan / (np.pi / 4),
+                'muted': self.muted,
+                'looping': self.looping,
+                'interval': [self.min_interval, self.max_interval] if self.min_interval > -1 else None,
+                'trim': [self.trimLeft / 1000, self.trimRight / 1000] if self.trimLeft > -1 else None,
+                'polyphony': self.polyphony,
+                'steal': self.steal,
+                'automation': [dict(x) for x in self.automation.settings],
+                'filter': dict(self.filter.settings) if self.filter else None,
+                'send': self.send,
+                'normalize': self.normalize,
+                'spread': self.spread}
+
+    # Missing keys fall back to the defaults of a newly added sound
+    def apply_settings(self, settings):
+        self.volume = float(settings.get('volume', 1.0))
+        self.set_pan(float(settings.get('pan', 0.0)) * 100)
+        self.muted = bool(settings.get('muted', False))
+        self.looping = bool(settings.get('looping', True))
+        interval = settings.get('interval')
+        self.min_interval, self.max_interval = (float(interval[0]), float(interval[1])) if interval else (-1, -1)
+        trim = settings.get('trim')
+        if trim:
+            self.trimLeft = int(round(float(trim[0]), 3) * 1000)
+            self.trimRight = int(round(float(trim[1]), 3) * 1000)
+        else:
+            self.trimLeft = -1
+            self.trimRight = -1
+        self.steal = settings.get('steal', 'oldest')
+        self.set_automation(settings.get('automation', []))
+        self.set_filter(settings.get('filter'))
+        self.send = float(settings.get('send', 0.0))
+        self.set_normalize(settings.get('normalize'))
+        self.spread = float(settings.get('spread', SPREAD_DEGREES))
+        self.polyphony = max(1, min(int(settings.get('polyphony', 1)), MAX_POLYPHONY))
+        self.update_trim() # Also rebuilds the voice pool
+
+    # A copy of this player's settings on another engine, sharing the decoded audio
+    def clone(self, engine):
+        player = AudioPlayer(self.filename, self.extension, engine, self.buffer)
+        player.apply_settings(self.settings())
+        return player
+
+    def schedule_next(self, frame):
+        randomHolder = self.engine.rng.uniform(self.min_interval, self.max_interval)
+        self.engine.scheduler.schedule(frame + int(randomHolder * self.engine.rate), self, self.generation)
+
+    # Starts a voice at frame offset of the current block, returns its slot or None if skipped.
+    # Only called from the mixing thread.
+    def trigger(self, offset):
+        frame = self.engine.frame_time + offset
+        if self.polyphony > 1 and not self.looping and self.min_interval > -1:
+            self.schedule_next(frame) # Onset to onset, even if this hit is skipped
+        pool = self.pool
+        slot = pool.allocate_slot(self.steal)
+        if slot is None:
+            return None
+        if pool.active[slot] and offset > pool.offsets[slot] and self.rendered_frame != self.engine.frame_time:
+            # Stealing a voice this block has not rendered yet, it plays up to the new onset.
+            # Otherwise a hit started earlier in a block crowded with onsets would vanish.
+            self.render(self.engine.mix_buffer, slot, slot + 1, offset)
+        pool.positions[slot] = 0
+        pool.offsets[slot] = offset
+        pool.started[slot] = frame
+        pool.active[slot] = True
+        self.playing = True
+        return slot
+
+    # Sums this sound's voices into its columns of the engine's sources matrix in one
+    # vectorized pass, gathering from the shared samples into preallocated blocks. The
+    # engine pans every sound onto the outputs together once all have rendered.
+    # lo, hi - slots to render, all of them by default
+    # stop - frame of the block to cut the voices at, leaving their playheads alone because
+    #   their slots are about to be reused. None to play the whole block.
+    def render(self, mix, lo=0, hi=None, stop=None):
+        pool = self.pool
+        # If not playing - contributes nothing
+        if not self.playing:
+            pool.count = 0
+            return
+        if self.start_pending:
+            self.start_pending = False
+            self.automation.restart()
+            self.gain_key = None # Nothing is sounding, so skip the glide from the last settings
+            self.trigger(0)
+
+        frame_count = len(mix)
+        length = len(self.samples)
+        if length == 0:
+            return
+        if len(pool.ramp) < frame_count:
+            pool.allocate(frame_count, self.engine.source_channels)
+        if hi is None:
+            self.rendered_frame = self.engine.frame_time
+            pool.compact()
+            hi = pool.count
+        if hi <= lo:
+            if self.filter: # Nothing left ringing into the next hit
+                self.filter.reset()
+            return
+
+        # Sample index every voice reads for every frame of the block
+        positions = pool.positions[lo:hi]
+        offsets = pool.offsets[lo:hi]
+        index = pool.index[lo:hi, :frame_count]
+        silent = pool.silent[lo:hi, :frame_count]
+        ramp = pool.ramp[:frame_count]
+        # Row by row with scalars, broadcasting a column here makes numpy allocate iteration buffers
+        for voice in range(hi - lo):
+            np.add(ramp, positions[voice] - offsets[voice], out=index[voice])
+            np.less(ramp, offsets[voice], out=silent[voice]) # Not started yet
+        if self.looping:
+            np.remainder(index, length, out=index)
+        else:
+            past_end = pool.past_end[lo:hi, :frame_count]
+            np.greater_equal(index, length, out=past_end)
+            np.logical_or(silent, past_end, out=silent)
+        if stop is not None:
+            silent[:, stop:] = True
+
+        # Once per block, start_due may render a new voice after the others
+        again = self.gain_frame == self.engine.frame_time
+        if not again:
+            self.gain_frame = self.engine.frame_time
+            self.update_gains(frame_count)
+
+        # If silent (muted or faded out), contribute nothing but still advance the playheads
+        if self.ramping or self.gains.any():
+            engine = self.engine
+            gathered = pool.gathered[lo:hi, :frame_count]
+            np.take(self.samples, index, axis=0, out=gathered, mode='clip')
+            np.copyto(gathered, 0, where=silent[:, :, None]) # A where mask avoids a bool-to-float cast buffer
+            channels = len(self.gains)
+            row = engine.claim_rows(channels)
+            staged = engine.sources[:, row:row + channels]
+            for channel in range(channels): # Summing into the column-major block at once would make numpy buffer it
+                np.sum(gathered[:, :, channel], axis=0, out=staged[:, channel])
+            sound_filter = self.filter
+            if sound_filter:
+                sound_filter.process(staged, again)
+            engine.row_gains[row:row + channels] = self.gains
+            engine.previous_row_gains[row:row + channels] = self.previous_gains
+            engine.ramping = engine.ramping or self.ramping
+            if self.send > 0 and engine.bus_active:
+                engine.row_sends[row:row + channels] = self.send
+                engine.sending = True
+            else:
+                engine.row_sends[row:row + channels] = 0
+        if stop is not None:
+            return
+
+        # Advance every playhead, looping ones wrap and one-shots that reached the end finish
+        advanced = positions + (frame_count - offsets)
+        if self.looping:
+            np.remainder(advanced, length, out=positions)
+        else:
+            for slot in np.flatnonzero(advanced >= length):
+                end_frame = self.engine.frame_time + offsets[slot] + length - positions[slot]
+                self.finish(lo + int(slot), int(end_frame))
+            positions[:] = advanced
+        offsets[:] = 0
+
+        # Long files only keep about a second of played audio resident
+        if self.buffer.windowed and pool.count:
+            low = int(pool.positions[:pool.count].min())
+            if low < self.release_mark or low - self.release_mark >= self.engine.rate:
+                self.release_played(low)
+
+    # Moves the gain matrix one block towards volume, pan, mute and automation.
+    # The pan law only runs when its inputs change, and a one-pole glide at block rate,
+    # ramped linearly across each block by the engine, keeps slider moves and automation
+    # from clicking.
+    def update_gains(self, frame_count):
+        gain, pan = self.automation.next(frame_count, self.engine.rng)
+        volume = 0.0 if self.muted else self.volume * self.normalize_gain * gain
+        pan = min(max(self.pan + pan * np.pi / 4, -np.pi / 4), np.pi / 4)
+        if (volume, pan, self.spread) != self.gain_key:
+            starting = self.gain_key is None
+            self.gain_key = (volume, pan, self.spread)
+            self.engine.pan_gains(volume, pan / (np.pi / 4), self.spread, self.target_gains)
+            if starting: # Only changes glide, a sound starts straight at its level
+                self.gains[:] = self.target_gains
+        if frame_count != self.smoothing_frames:
+            self.smoothing_frames = frame_count
+            self.smoothing = smoothing_coefficient(frame_count, self.engine.rate, SMOOTHING_SECONDS)
+        self.previous_gains[:] = self.gains
+        self.ramping = False
+        steps = np.subtract(self.target_gains, self.gains, out=self.gain_steps)
+        distance = float(np.abs(steps).max())
+        if distance > GAIN_EPSILON:
+            steps *= self.smoothing
+            self.gains += steps
+            self.ramping = True
+            distance *= 1 - self.smoothing
+        if distance <= GAIN_EPSILON: # Close enough everywhere, stop gliding
+            self.gains[:] = self.target_gains
+
+    def finish(self, slot, end_frame):
+        pool = self.pool
+        pool.active[slot] = False
+        if self.polyphony == 1 and self.min_interval > -1:
+            self.schedule_next(end_frame)
+        if not pool.active[:pool.count].any():
+            self.playing = False
+
+    # low - the earliest playhead, everything before it has been played
+    def release_played(self, low):
+        if low < self.release_mark: # Wrapped, so the tail has been played too
+            self.buffer.release(self.trim_start + self.release_mark, self.trim_start + len(self.samples))
+        else:
+            self.buffer.release(self.trim_start + self.release_mark, self.trim_start + low)
+        self.release_mark = low
+
+    def toggle_play(self):
+        self.generation += 1 # prevents lingering one-shot triggers
+        self.playing = not self.playing
+        self.start_pending = self.playing
+        if self.playing: # After the flip, so a sweep running now sees the sound as wanted
+            buffer_manager.acquire(self)
+
+    def toggle_mute(self):
+        self.muted = not self.muted
+        if not self.muted:
+            buffer_manager.acquire(self)
+
+    def toggle_loop(self):
+        self.looping = not self.looping
+
+    def set_volume(self, value):
+        self.volume = value / 100.0
+
+    def set_pan(self, value):
+        # Convert slider value (-100 to 100) to radians (-pi/4 to pi/4) for dB
+        self.pan = value / 100.0 * np.pi / 4
+
+    def stop(self):
+        self.generation += 1
+        self.engine.remove_voice(self)
+        buffer_manager.unregister(self)
@@ -0,0 +1,213 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from engine import AudioEngine, format_stats
+from backends import AudioConfig, BACKENDS, CONFIG_PATH, make_backend
+from render import render_to_file, parse_seed
+from scene import load_scene, build_players
+from buffers import buffer_manager, format_memory
+from loader import pcm_cache, format_cache
+from stream import StreamBackend, make_sink
+
+# Command line runner for scene files, plays or renders without importing PyQt5
+#   python headless.py play scene.json [--duration SECONDS] [--stats-interval SECONDS] [--log-file PATH]
+#                     [--audio-config PATH] [--backend NAME] [--device DEVICE] [--block-size FRAMES] [--latency LATENCY]
+#                     [--memory-budget MB]
+#   python headless.py stream scene.json --sink SINK [--sink SINK ...] [--rotate-seconds SECONDS] [--rotate-mb MB]
+#                     [--keep FILES] [--offline] [--duration SECONDS] [--seed SEED]
+#   python headless.py render scene.json out.wav --duration SECONDS [--seed SEED] [--audio-config PATH] [--block-size FRAMES]
+#   python headless.py batch scene.json sweep.json out_dir --duration SECONDS [--workers N] [--audio-config PATH]
+#                     [--block-size FRAMES]
+
+# The audio config file, with any settings given on the command line on top
+def audio_config(args):
+    config = AudioConfig.load(args.audio_config)
+    for key in ('backend', 'device', 'block_size', 'latency', 'output_file'):
+        value = getattr(args, key, None)
+        if value is not None:
+            setattr(config, key, value)
+    if config.device is not None and str(config.device).isdigit():
+        config.device = int(config.device)
+    if config.latency is not None and config.latency not in ('low', 'high'):
+        config.latency = float(config.latency)
+    return config
+
+def play(args):
+    config = audio_config(args)
+    engine = AudioEngine(config.rate, config.channels, config.block_size, config.speakers)
+    engine.rng.seed(parse_seed(args.seed))
+    scene = load_scene(args.scene)
+    engine.bus.configure(scene['bus'])
+    players = build_players(scene, engine)
+    for player in players:
+        engine.add_voice(player)
+    engine.start(make_backend(config))
+    if args.memory_budget is not None:
+        buffer_manager.budget = int(args.memory_budget * 1024 ** 2)
+    buffer_manager.start()
+    engine.playing = True
+    for player in players:
+        player.toggle_play()
+    try:
+        started = time.monotonic()
+        next_stats = started + args.stats_interval
+        while args.duration is None or time.monotonic() - started < args.duration:
+            time.sleep(0.1)
+            if args.stats_interval > 0 and time.monotonic() >= next_stats:
+                logging.info(format_stats(engine.stats.snapshot()) + ", " + format_memory(buffer_manager.stats()) +
+                             ", " + format_cache(pcm_cache.stats()))
+                next_stats += args.stats_interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.playing = False
+        engine.stop()
+        logging.info("stopped: " + format_stats(engine.stats.snapshot()))
+
+# Runs a scene indefinitely (or for --duration seconds of audio) into files, stdout or a
+# FIFO instead of a sound card. Stops early once every sink has failed.
+def stream(args):
+    config = audio_config(args)
+    config.realtime = not args.offline
+    sinks = [make_sink(spec, args.rotate_seconds, args.rotate_mb * 1024 ** 2 if args.rotate_mb else None, args.keep)
+             for spec in args.sink]
+    engine = AudioEngine(config.rate, config.channels, config.block_size, config.speakers)
+    engine.rng.seed(parse_seed(args.seed))
+    scene = load_scene(args.scene)
+    engine.bus.configure(scene['bus'])
+    players = build_players(scene, engine)
+    for player in players:
+        engine.add_voice(player)
+    if args.memory_budget is not None:
+        buffer_manager.budget = int(args.memory_budget * 1024 ** 2)
+    buffer_manager.start()
+    engine.playing = True
+    for player in players:
+        player.toggle_play()
+    backend = StreamBackend(config, sinks, int(args.duration * config.rate) if args.duration is not None else None)
+    engine.start(backend) # Every sound starts on the first block
+    failed = 0
+    try:
+        next_stats = time.monotonic() + args.stats_interval
+        while not backend.finished.wait(0.1):
+            errors = backend.errors
+            for error in errors[failed:]:
+                logging.error(f"sink stopped: {error}")
+            failed = len(errors)
+            if failed == len(sinks):
+                break
+            if args.stats_interval > 0 and time.monotonic() >= next_stats:
+                logging.info(format_stats(engine.stats.snapshot()) + ", " + format_memory(buffer_manager.stats()) +
+                             ", " + format_cache(pcm_cache.stats()) +
+                             f", {backend.written / engine.rate:.0f} s streamed, {backend.dropped} blocks dropped")
+                next_stats += args.stats_interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.playing = False
+        engine.stop()
+        logging.info(f"stopped after {backend.written / engine.rate:.1f} s streamed, {backend.dropped} blocks dropped: " +
+                     format_stats(engine.stats.snapshot()))
+
+# Renders in the configured format and block size, so a seeded render matches stream --offline
+def render(args):
+    config = audio_config(args)
+    scene = load_scene(args.scene)
+    players = build_players(scene, AudioEngine(config.rate, config.channels, config.block_size, config.speakers))
+    frames = render_to_file(players, args.output, args.duration, parse_seed(args.seed), config.rate, config.channels,
+                            config.block_size, bus=scene['bus'], speakers=config.speakers)
+    print(f"Rendered {frames} frames to {args.output}")
+
+def batch(args):
+    # Imported here so the other commands do not pay for the process pool machinery
+    from batch import render_batch
+    sweep = {}
+    if args.sweep:
+        with open(args.sweep) as f:
+            sweep = json.load(f)
+    name = os.path.splitext(os.path.basename(args.scene))[0]
+    progress = lambda done, total: print(f"{done}/{total} rendered", flush=True)
+    config = audio_config(args)
+    manifest = render_batch(load_scene(args.scene), sweep, args.out_dir, args.duration, args.workers,
+                            args.format, args.count, name, progress, config.rate, config.channels, config.block_size,
+                            config.speakers)
+    print(f"Rendered {len(manifest)} variants to {args.out_dir}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play or render a Soundscape Architect scene without the GUI")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    play_parser = commands.add_parser('play', help="play a scene live until interrupted")
+    play_parser.add_argument('scene')
+    play_parser.add_argument('--duration', type=float, help="stop after this many seconds")
+    play_parser.add_argument('--seed', help="seed for the one-shot intervals")
+    play_parser.add_argument('--stats-interval', type=float, default=60,
+                             help="seconds between engine stats log lines, 0 to disable")
+    play_parser.add_argument('--log-file', help="append logs here instead of stderr")
+    play_parser.add_argument('--audio-config', default=CONFIG_PATH, help="JSON audio settings, default %(default)s")
+    play_parser.add_argument('--backend', choices=sorted(BACKENDS), help="overrides the audio config")
+    play_parser.add_argument('--device', help="output device index or name, overrides the audio config")
+    play_parser.add_argument('--block-size', type=int, help="frames per block, overrides the audio config")
+    play_parser.add_argument('--latency', help="'low', 'high' or seconds (sounddevice only)")
+    play_parser.add_argument('--output-file', help="where the file backend writes")
+    play_parser.add_argument('--memory-budget', type=float,
+                             help="MB of decoded audio kept in memory, default $SOUNDSCAPE_MEMORY_BUDGET_MB or 1024")
+    play_parser.set_defaults(func=play)
+
+    stream_parser = commands.add_parser('stream', help="stream a scene to rotating files, stdout or a FIFO")
+    stream_parser.add_argument('scene')
+    stream_parser.add_argument('--sink', action='append', required=True,
+                               help="'-' for raw 16-bit PCM on stdout, 'pipe:PATH' for raw PCM to a FIFO, "
+                                    "or an audio file pattern such as 'archive/%%Y%%m%%d-%%H%%M.flac'; repeatable")
+    stream_parser.add_argument('--rotate-seconds', type=float, help="start a new file after this much audio")
+    stream_parser.add_argument('--rotate-mb', type=float, help="start a new file once one reaches this size")
+    stream_parser.add_argument('--keep', type=int, help="delete all but this many of the newest files")
+    stream_parser.add_argument('--offline', action='store_true',
+                               help="mix as fast as the sinks take it instead of in real time")
+    stream_parser.add_argument('--duration', type=float, help="stop after this many seconds of audio")
+    stream_parser.add_argument('--seed', help="seed for the one-shot intervals")
+    stream_parser.add_argument('--stats-interval', type=float, default=60,
+                               help="seconds between engine stats log lines, 0 to disable")
+    stream_parser.add_argument('--log-file', help="append logs here instead of stderr")
+    stream_parser.add_argument('--audio-config', default=CONFIG_PATH, help="JSON audio settings for the rate, channels and block size")
+    stream_parser.add_argument('--block-size', type=int, help="frames per block, overrides the audio config")
+    stream_parser.add_argument('--memory-budget', type=float,
+                               help="MB of decoded audio kept in memory, default $SOUNDSCAPE_MEMORY_BUDGET_MB or 1024")
+    stream_parser.set_defaults(func=stream)
+
+    render_parser = commands.add_parser('render', help="render a scene to a WAV/FLAC file")
+    render_parser.add_argument('scene')
+    render_parser.add_argument('output')
+    render_parser.add_argument('--duration', type=float, required=True, help="length in seconds")
+    render_parser.add_argument('--seed', help="seed for the one-shot intervals")
+    render_parser.add_argument('--audio-config', default=CONFIG_PATH, help="JSON audio settings for the rate, channels and block size")
+    render_parser.add_argument('--block-size', type=int, help="frames per block, overrides the audio config")
+    render_parser.set_defaults(func=render)
+
+    batch_parser = commands.add_parser('batch', help="render every variant of a parameter sweep in parallel")
+    batch_parser.add_argument('scene')
+    batch_parser.add_argument('sweep', nargs='?', help="JSON object of parameter to list of values")
+    batch_parser.add_argument('out_dir')
+    batch_parser.add_argument('--duration', type=float, required=True, help="length of each variant in seconds")
+    batch_parser.add_argument('--workers', type=int, help="worker processes, defaults to the CPU count")
+    batch_parser.add_argument('--count', type=int, default=1, help="seeds per combination when the sweep has none")
+    batch_parser.add_argument('--format', default='wav', choices=['wav', 'flac'])
+    batch_parser.add_argument('--audio-config', default=CONFIG_PATH, help="JSON audio settings for the rate, channels and block size")
+    batch_parser.add_argument('--block-size', type=int, help="frames per block, overrides the audio config")
+    batch_parser.set_defaults(func=batch)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(filename=getattr(args, 'log_file', None), level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        args.func(args)
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loader import load_buffer
+from peaks import load_peaks
+from loudness import load_loudness
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.ogg', '.aac', '.m4a', '.flac', '.aif', '.aiff')
+IMPORT_WORKERS = min(4, os.cpu_count() or 1) # Decoding is mostly I/O and ffmpeg, a few threads keep the disk busy
+
+# Every audio file under folder, sorted so a folder always imports in the same order
+def find_audio_files(folder):
+    found = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(AUDIO_EXTENSIONS) and not name.startswith('.'):
+                found.append(os.path.join(root, name))
+    return found
+
+# Decodes many files on a bounded thread pool without blocking the caller. The callbacks
+# run on the worker threads as each file finishes, so GUI code should hand them to its
+# own thread (a Qt signal does this):
+#   loaded(index, path, buffer) - a file is decoded, its peaks and loudness measured, and ready to play
+#   failed(index, path, error) - a file could not be decoded
+#   progress(done, total) - after every file, loaded, failed or skipped
+#   finished(cancelled) - once, after the last file
+# Cancelling skips files that have not started; decodes already running finish but are dropped.
+class ImportJob:
+    def __init__(self, paths, rate, channels, loaded, failed=None, progress=None, finished=None, workers=IMPORT_WORKERS):
+        self.paths = list(paths)
+        self.rate = rate
+        self.channels = channels
+        self.loaded = loaded
+        self.failed = failed
+        self.progress = progress
+        self.finished = finished
+        self.workers = workers
+        self.cancelled = threading.Event()
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        if not self.paths:
+            if self.finished:
+                self.finished(False)
+            return
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='import')
+        for index, path in enumerate(self.paths):
+            executor.submit(self.load, index, path)
+        executor.shutdown(wait=False) # Worker threads exit once the queue drains
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def load(self, index, path):
+        try:
+            if self.cancelled.is_set():
+                return
+            try:
+                buffer = load_buffer(path, self.rate, self.channels)
+                load_peaks(buffer) # So the row can draw its waveform straight away
+                load_loudness(buffer, self.rate) # And normalize without measuring on the GUI thread
+            except Exception as e: # Anything ffmpeg or libsndfile reject is reported per file
+                if self.failed and not self.cancelled.is_set():
+                    self.failed(index, path, e)
+                return
+            if not self.cancelled.is_set():
+                self.loaded(index, path, buffer)
+        finally:
+            with self.lock:
+                self.done += 1
+                done = self.done
+            if self.progress:
+                self.progress(done, len(self.paths))
+            if done == len(self.paths) and self.finished:
+                self.finished(self.cancelled.is_set())
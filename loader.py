@@ -0,0 +1,289 @@
+import hashlib
+import math
+import mmap
+import os
+import threading
+import weakref
+import numpy as np
+import soundfile as sf
+from pydub import AudioSegment
+from scipy.signal import resample_poly
+
+CACHE_DIR = os.environ.get('SOUNDSCAPE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'soundscape-architect'))
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+LARGE_FILE_BYTES = 64 * 1024 ** 2 # Decoded sizes above this are played through a window of the mapping
+RESAMPLER = 'poly-kaiser5' # Part of the cache key, so entries made by another resampler are not reused
+
+# Decoded samples plus, when they come from the cache, the read-only mapping behind them
+class PcmBuffer:
+    def __init__(self, samples, mapping=None, data_offset=0):
+        self.samples = samples
+        self.mapping = mapping
+        self.data_offset = data_offset # Byte offset of the first sample within the mapping
+        self.frame_bytes = samples.shape[1] * samples.itemsize
+        self.key = None # PcmCache key of the samples, None when they were not cached
+        self.peaks = None # PeakPyramid for drawing, built on first use by peaks.load_peaks
+        self.loudness = None # Loudness measurement, made on first use by loudness.load_loudness
+
+    @property
+    def nbytes(self):
+        return self.samples.nbytes
+
+    @property
+    def windowed(self):
+        return self.mapping is not None and self.nbytes >= LARGE_FILE_BYTES
+
+    # Drops already-played pages of frames start..end from this process, so resident
+    # memory follows the playhead instead of growing to the length of the file
+    def release(self, start, end):
+        if self.mapping is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        first = self.data_offset + start * self.frame_bytes
+        last = self.data_offset + end * self.frame_bytes
+        first = -(-first // mmap.PAGESIZE) * mmap.PAGESIZE # Only whole pages inside the range
+        last = last // mmap.PAGESIZE * mmap.PAGESIZE
+        if last > first:
+            self.mapping.madvise(mmap.MADV_DONTNEED, first, last - first)
+
+    # Reads frames start..end back into this process after release, asking the kernel to
+    # read ahead and then touching every page, so playback does not wait on the disk
+    def prefetch(self, start=0, end=None):
+        if self.mapping is None:
+            return
+        end = len(self.samples) if end is None else min(end, len(self.samples))
+        if end <= start:
+            return
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            first = (self.data_offset + start * self.frame_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+            self.mapping.madvise(mmap.MADV_WILLNEED, first, self.data_offset + end * self.frame_bytes - first)
+        flat = self.samples[start:end].reshape(-1)
+        flat[::mmap.PAGESIZE // flat.itemsize].sum() # One read per page faults the whole range in
+
+# Maps a .npy file read-only without reading its samples
+def map_npy(path):
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    count = int(np.prod(shape))
+    samples = np.frombuffer(mapping, dtype=dtype, count=count, offset=data_offset).reshape(shape)
+    return PcmBuffer(samples, mapping, data_offset)
+
+# On-disk cache of decoded PCM, one .npy file per source so hits can be memory-mapped
+# without running ffmpeg. Entries are keyed by the file's content hash, size and mtime
+# plus the engine format, and the least recently used ones are evicted past max_bytes.
+class PcmCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def key(self, filename, rate, channels):
+        st = os.stat(filename)
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(f'{st.st_size}:{st.st_mtime_ns}:{rate}:{channels}:{RESAMPLER}'.encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    # Waveform peaks and loudness of an entry, evicted along with it
+    def peaks_path(self, key):
+        return os.path.join(self.directory, key + '.peaks')
+
+    def loudness_path(self, key):
+        return os.path.join(self.directory, key + '.loudness')
+
+    # Returns a PcmBuffer mapping the cached samples, or None on a miss
+    def get(self, key):
+        buffer = self.open(key)
+        with self.lock:
+            if buffer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return buffer
+
+    def open(self, key):
+        path = self.path(key)
+        try:
+            buffer = map_npy(path)
+            os.utime(path) # Recency for LRU eviction is tracked through mtime
+        except (OSError, ValueError):
+            return None
+        return buffer
+
+    def temp_path(self, key):
+        os.makedirs(self.directory, exist_ok=True)
+        return f'{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    def put(self, key, samples):
+        temp_path = self.temp_path(key)
+        with open(temp_path, 'wb') as f:
+            np.save(f, samples)
+        os.replace(temp_path, self.path(key)) # Readers never see a half-written entry
+        self.evict(keep=key)
+
+    # Decodes and resamples straight into the cache entry block by block, so even hour-long
+    # recordings never need the whole file in memory. Only for formats libsndfile reads,
+    # returns False so the caller can fall back to decode_samples otherwise
+    def put_file(self, key, filename, rate, channels, block=1 << 16):
+        try:
+            f = sf.SoundFile(filename)
+        except RuntimeError:
+            return False
+        with f:
+            if f.frames <= 0:
+                return False
+            temp_path = self.temp_path(key)
+            out = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32,
+                                            shape=(resampled_length(f.frames, f.samplerate, rate), channels))
+            position = 0
+            for data in resampled_blocks(f, rate, block):
+                out[position:position + len(data)] = match_channels(data, channels)
+                position += len(data)
+            out.flush()
+            del out
+        os.replace(temp_path, self.path(key))
+        self.evict(keep=key)
+        return True
+
+    # Deletes least recently used entries until the cache fits in max_bytes
+    # keep - a key that is never evicted, so a fresh entry can always be opened
+    def evict(self, keep=None):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.npy'):
+                    try:
+                        st = os.stat(os.path.join(self.directory, name))
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, name))
+            total = sum(x[1] for x in entries)
+            for mtime, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if name == f'{keep}.npy':
+                    continue
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError: # Still mapped on platforms that lock mapped files
+                    continue
+                for path in (self.peaks_path(name[:-len('.npy')]), self.loudness_path(name[:-len('.npy')])):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        entries = 0
+        size = 0
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.npy'):
+                    entries += 1
+                    size += os.path.getsize(os.path.join(self.directory, name))
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'entries': entries,
+                    'bytes': size,
+                    'max_bytes': self.max_bytes}
+
+pcm_cache = PcmCache()
+
+def format_cache(stats):
+    return (f"PCM cache {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate'] * 100:.0f}%), "
+            f"{stats['entries']} entries, {stats['bytes'] / 1024 ** 2:.0f} of {stats['max_bytes'] / 1024 ** 2:.0f} MB, "
+            f"{stats['evictions']} evicted")
+
+# Maps source channels onto the engine layout: equal counts pass through, mono is
+# copied to every channel and anything else is mixed down to mono first
+def match_channels(data, channels):
+    if data.shape[1] == channels:
+        return data
+    if data.shape[1] != 1:
+        data = data.mean(axis=1, keepdims=True)
+    return np.broadcast_to(data, (len(data), channels))
+
+# Up and down factors taking source_rate to rate, reduced so the polyphase filter stays short
+def resample_factors(source_rate, rate):
+    g = math.gcd(source_rate, rate)
+    return rate // g, source_rate // g
+
+def resampled_length(frames, source_rate, rate):
+    up, down = resample_factors(source_rate, rate)
+    return -(-frames * up // down)
+
+# Reads an open SoundFile as float32 blocks at rate, polyphase resampled. Blocks start on
+# multiples of the down factor and are filtered with enough neighbouring input on either
+# side that the joined output equals resampling the whole file in one call.
+def resampled_blocks(f, rate, block=1 << 16):
+    up, down = resample_factors(f.samplerate, rate)
+    if up == down:
+        yield from f.blocks(blocksize=block, dtype='float32', always_2d=True)
+        return
+    # resample_poly's filter spans 10 * max(up, down) taps either side at the upsampled rate
+    pad = -(-(10 * max(up, down) // up + 2) // down) * down
+    step = -(-block // down) * down
+    for start in range(0, f.frames, step):
+        end = min(start + step, f.frames)
+        low = max(start - pad, 0)
+        f.seek(low)
+        data = f.read(min(end + pad, f.frames) - low, dtype='float32', always_2d=True)
+        resampled = resample_poly(data, up, down, axis=0)
+        first = (start - low) * up // down
+        yield resampled[first:first + resampled_length(end, f.samplerate, rate) - start * up // down]
+
+# Decodes a file through ffmpeg into a contiguous float32 (frames x channels) array
+# in the engine's rate and channel layout, scaled to -1.0..1.0
+def decode_samples(filename, rate, channels):
+    segment = AudioSegment.from_file(filename)
+    samples = np.array(segment.get_array_of_samples(), dtype=np.float32).reshape(-1, segment.channels)
+    samples /= float(1 << (8 * segment.sample_width - 1))
+    samples = match_channels(samples, channels)
+    up, down = resample_factors(segment.frame_rate, rate)
+    if up != down:
+        samples = resample_poly(samples, up, down, axis=0)
+    return np.ascontiguousarray(samples, dtype=np.float32)
+
+shared_buffers = weakref.WeakValueDictionary() # Cache key to the PcmBuffer already open for it
+shared_lock = threading.Lock()
+
+# Decodes a file once, reusing the cached PCM from an earlier load when there is one, and
+# returns the PcmBuffer so callers can release played pages. Every sound using the same
+# file and format shares one mapping.
+# cache - the PcmCache to use, None to always decode
+def load_buffer(filename, rate, channels, cache=pcm_cache):
+    if cache is None:
+        return PcmBuffer(decode_samples(filename, rate, channels))
+    key = cache.key(filename, rate, channels)
+    with shared_lock:
+        buffer = shared_buffers.get(key)
+    if buffer is not None:
+        return buffer
+    buffer = cache.get(key)
+    if buffer is None:
+        if not cache.put_file(key, filename, rate, channels):
+            cache.put(key, decode_samples(filename, rate, channels))
+        # Map the new entry so the decoded copy can be freed
+        buffer = cache.open(key) or PcmBuffer(decode_samples(filename, rate, channels))
+    buffer.key = key
+    with shared_lock:
+        return shared_buffers.setdefault(key, buffer)
@@ -0,0 +1,98 @@
+import json
+import math
+import os
+import numpy as np
+from scipy.signal import lfilter
+from loader import pcm_cache
+
+ANALYSIS_FRAMES = 1 << 18 # Frames filtered per pass, bounds the memory used on long files
+NORMALIZE_TARGET = -23.0 # LUFS a normalized sound is brought to by default
+NORMALIZE_MAX_GAIN_DB = 24.0 # So normalizing near-silence does not turn up the noise floor
+
+# K-weighting filter of ITU-R BS.1770 (a high shelf, then a high-pass) for any sample rate
+def k_weighting(rate):
+    k = math.tan(math.pi * 1681.974450955533 / rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0],
+             [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    k = math.tan(math.pi * 38.13547087602444 / rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = ([1, -2, 1], [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return shelf, high_pass
+
+# Integrated loudness (BS.1770 gating, LUFS), RMS and peak of (frames x channels) samples,
+# in dB with None for silence. Samples are read in passes with the filter state carried
+# over, and 100 ms mean squares are kept, from which the overlapping 400 ms gating blocks
+# are formed, so an hour-long file needs a few hundred kilobytes.
+def measure_loudness(samples, rate, release=None):
+    frames, channels = samples.shape
+    hop = int(rate * 0.1)
+    shelf, high_pass = k_weighting(rate)
+    shelf_state = np.zeros((2, channels))
+    high_pass_state = np.zeros((2, channels))
+    hops = np.zeros((-(-frames // hop), channels))
+    square_sum = 0.0
+    peak = 0.0
+    step = ANALYSIS_FRAMES // hop * hop # Passes start on hop boundaries
+    for start in range(0, frames, step):
+        part = samples[start:start + step].astype(np.float64)
+        square_sum += float(np.square(part).sum())
+        peak = max(peak, float(np.abs(part).max()))
+        weighted, shelf_state = lfilter(*shelf, part, axis=0, zi=shelf_state)
+        weighted, high_pass_state = lfilter(*high_pass, weighted, axis=0, zi=high_pass_state)
+        squares = np.square(weighted)
+        full = len(squares) // hop
+        first = start // hop
+        hops[first:first + full] = squares[:full * hop].reshape(full, hop, channels).mean(axis=1)
+        if len(squares) > full * hop: # Short last hop
+            hops[first + full] = squares[full * hop:].mean(axis=0)
+        if release:
+            release(start, start + len(part))
+
+    # 400 ms blocks overlapping by 75%, every channel weighted 1 as for left, right and centre
+    if len(hops) >= 4:
+        blocks = (hops[:-3] + hops[1:-2] + hops[2:-1] + hops[3:]).sum(axis=1) / 4
+    else:
+        blocks = np.array([hops.sum() / 4]) # Shorter than one block, as if padded with silence
+    lufs = None
+    gated = blocks[-0.691 + 10 * np.log10(np.maximum(blocks, 1e-20)) > -70]
+    if len(gated):
+        relative = -0.691 + 10 * math.log10(gated.mean()) - 10
+        gated = gated[-0.691 + 10 * np.log10(gated) > relative]
+        lufs = -0.691 + 10 * math.log10(gated.mean())
+    rms = math.sqrt(square_sum / max(frames * channels, 1))
+    return {'lufs': lufs,
+            'rms_db': 20 * math.log10(rms) if rms > 0 else None,
+            'peak_db': 20 * math.log10(peak) if peak > 0 else None}
+
+# Returns the PcmBuffer's loudness, measuring it on first use and keeping it in the PCM
+# cache next to the decoded samples so later loads only read a few bytes
+def load_loudness(buffer, rate, cache=pcm_cache):
+    if buffer.loudness is not None:
+        return buffer.loudness
+    key = buffer.key if cache is not None else None
+    if key is not None:
+        try:
+            with open(cache.loudness_path(key)) as f:
+                buffer.loudness = json.load(f)
+            return buffer.loudness
+        except (OSError, ValueError):
+            pass
+    loudness = measure_loudness(buffer.samples, rate, buffer.release if buffer.windowed else None)
+    if key is not None:
+        temp_path = cache.temp_path(key)
+        with open(temp_path, 'w') as f:
+            json.dump(loudness, f)
+        os.replace(temp_path, cache.loudness_path(key))
+    buffer.loudness = loudness
+    return loudness
+
+# Linear gain taking a sound measured at loudness to target LUFS, 1.0 for silence
+def normalize_gain(loudness, target=NORMALIZE_TARGET):
+    if loudness['lufs'] is None:
+        return 1.0
+    return 10 ** (min(target - loudness['lufs'], NORMALIZE_MAX_GAIN_DB) / 20)
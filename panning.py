@@ -0,0 +1,53 @@
+import math
+import numpy as np
+
+SPREAD_DEGREES = 60.0 # Angle between the two channels of a stereo sound on a speaker ring
+
+# Azimuths in degrees of channels speakers evenly spaced around the listener: 0 is straight
+# ahead and angles grow clockwise, so channel 0 is front left and the rest follow clockwise
+def ring_speakers(channels):
+    return [(i * 360 / channels - 180 / channels + 180) % 360 - 180 for i in range(channels)]
+
+# Constant-power gains placing a point source at azimuth (degrees) on a horizontal ring of
+# speakers, between the two speakers either side of it (2D vector base amplitude panning)
+def vbap_gains(azimuth, speakers):
+    gains = np.zeros(len(speakers))
+    angles = np.radians(np.asarray(speakers, dtype=np.float64))
+    order = np.argsort(angles % (2 * math.pi))
+    source = math.radians(azimuth) % (2 * math.pi)
+    for k in range(len(order)):
+        first, second = order[k], order[(k + 1) % len(order)]
+        start = angles[first] % (2 * math.pi)
+        width = (angles[second] - angles[first]) % (2 * math.pi) or 2 * math.pi
+        if (source - start) % (2 * math.pi) <= width:
+            break
+    base = np.array([[math.sin(angles[first]), math.sin(angles[second])],
+                     [math.cos(angles[first]), math.cos(angles[second])]])
+    if abs(np.linalg.det(base)) < 1e-6: # Speakers opposite each other, no pair spans the source
+        nearest = np.argmin(np.abs((angles - math.radians(azimuth) + math.pi) % (2 * math.pi) - math.pi))
+        gains[nearest] = 1.0
+        return gains
+    pair = np.maximum(np.linalg.solve(base, [math.sin(source), math.cos(source)]), 0.0)
+    pair /= np.sqrt(np.square(pair).sum())
+    gains[first] = pair[0]
+    gains[second] = pair[1]
+    return gains
+
+# Fills out, a (source channels x output channels) matrix, with the gains of a sound at
+# position -1..1 played at volume. Stereo output keeps the constant-power pan of each
+# channel to its own side. On a ring of more speakers the position is an azimuth from
+# -180 to 180 degrees, and a stereo sound's channels sit spread degrees apart around it.
+def pan_matrix(volume, position, spread, speakers, out):
+    out.fill(0)
+    sources, channels = out.shape
+    if channels == 1:
+        out[:, 0] = volume / sources
+    elif channels == 2:
+        pan = position * math.pi / 4
+        out[0, 0] = volume * math.sqrt(2) / 2.0 * (math.cos(pan) - math.sin(pan))
+        out[-1, 1] = volume * math.sqrt(2) / 2.0 * (math.cos(pan) + math.sin(pan))
+    else:
+        azimuth = position * 180
+        offsets = [-spread / 2, spread / 2] if sources == 2 else [0.0]
+        for source, offset in enumerate(offsets):
+            out[source] = vbap_gains(azimuth + offset, speakers) * (volume * math.sqrt(2) / 2.0)
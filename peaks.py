@@ -0,0 +1,99 @@
+import os
+import numpy as np
+from loader import pcm_cache
+
+PEAK_BLOCK = 256 # Frames summarized by one entry of the finest level
+BUILD_BLOCKS = 4096 # Finest-level entries computed per pass, bounds the memory used while building
+
+# Min/max peak pyramid of a sound for drawing its waveform. Level 0 holds the minimum and
+# maximum sample (over all channels) of every PEAK_BLOCK frames, and each level above
+# halves the previous one, so any view of any length reads about two entries per pixel.
+# All levels live in one (entries x 2) float32 array, level after level.
+class PeakPyramid:
+    def __init__(self, frames, data):
+        self.frames = frames
+        self.data = data
+        self.levels = []
+        offset = 0
+        length = -(-frames // PEAK_BLOCK)
+        while True:
+            self.levels.append(data[offset:offset + length])
+            offset += length
+            if length <= 1:
+                break
+            length = -(-length // 2)
+        if offset != len(data):
+            raise ValueError(f"peak data has {len(data)} entries, expected {offset}")
+
+    @classmethod
+    def build(cls, samples, release=None):
+        frames, channels = samples.shape
+        base = np.empty((-(-frames // PEAK_BLOCK), 2), dtype=np.float32)
+        for first in range(0, len(base), BUILD_BLOCKS):
+            low = first * PEAK_BLOCK
+            high = min(low + BUILD_BLOCKS * PEAK_BLOCK, frames)
+            part = samples[low:high]
+            full = len(part) // PEAK_BLOCK
+            blocks = part[:full * PEAK_BLOCK].reshape(full, PEAK_BLOCK * channels)
+            blocks.min(axis=1, out=base[first:first + full, 0])
+            blocks.max(axis=1, out=base[first:first + full, 1])
+            if len(part) > full * PEAK_BLOCK: # Short last block
+                base[first + full] = part[full * PEAK_BLOCK:].min(), part[full * PEAK_BLOCK:].max()
+            if release:
+                release(low, high)
+        levels = [base]
+        while len(levels[-1]) > 1:
+            previous = levels[-1]
+            pairs = len(previous) // 2
+            level = np.empty((-(-len(previous) // 2), 2), dtype=np.float32)
+            np.minimum(previous[0:pairs * 2:2, 0], previous[1:pairs * 2:2, 0], out=level[:pairs, 0])
+            np.maximum(previous[0:pairs * 2:2, 1], previous[1:pairs * 2:2, 1], out=level[:pairs, 1])
+            if len(level) > pairs: # Odd count, the last entry carries up unchanged
+                level[-1] = previous[-1]
+            levels.append(level)
+        return cls(frames, np.concatenate(levels))
+
+    # Minimum and maximum of frames start..end of samples split into pixels columns.
+    # Reads a level with at least one entry per column, or the samples themselves
+    # when zoomed in past PEAK_BLOCK frames per column.
+    def columns(self, samples, start, end, pixels):
+        start = max(0, min(int(start), self.frames))
+        end = max(start, min(int(end), self.frames))
+        if end == start or pixels <= 0:
+            return np.zeros(max(pixels, 0), np.float32), np.zeros(max(pixels, 0), np.float32)
+        edges = start + (end - start) * np.arange(pixels) // pixels
+        frames_per_pixel = (end - start) / pixels
+        if frames_per_pixel < PEAK_BLOCK:
+            flat_min = flat_max = samples[start:end].reshape(-1) # Frames are contiguous, so columns are too
+            index = (edges - start) * samples.shape[1]
+        else:
+            level = min(int(np.log2(frames_per_pixel / PEAK_BLOCK)), len(self.levels) - 1)
+            size = PEAK_BLOCK << level
+            first = start // size
+            last = -(-end // size)
+            flat_min = self.levels[level][first:last, 0]
+            flat_max = self.levels[level][first:last, 1]
+            index = edges // size - first
+        return np.minimum.reduceat(flat_min, index), np.maximum.reduceat(flat_max, index)
+
+# Returns the PcmBuffer's peak pyramid, building it on first use and keeping it in the
+# PCM cache next to the decoded samples so later loads only map it
+def load_peaks(buffer, cache=pcm_cache):
+    if buffer.peaks is not None:
+        return buffer.peaks
+    key = buffer.key if cache is not None else None
+    if key is not None:
+        try:
+            buffer.peaks = PeakPyramid(len(buffer.samples), np.load(cache.peaks_path(key), mmap_mode='r'))
+            return buffer.peaks
+        except (OSError, ValueError):
+            pass
+    # Release pages as they are read so building over a long mapped file stays small
+    peaks = PeakPyramid.build(buffer.samples, buffer.release if buffer.windowed else None)
+    if key is not None:
+        temp_path = cache.temp_path(key)
+        with open(temp_path, 'wb') as f:
+            np.save(f, peaks.data)
+        os.replace(temp_path, cache.peaks_path(key))
+    buffer.peaks = peaks
+    return peaks
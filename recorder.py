@@ -0,0 +1,65 @@
+import queue
+import threading
+import wave
+
+# Streams int16 PCM blocks to a WAV file from a bounded queue on its own thread.
+# The wave module patches the header after every write, so the file on disk is
+# always a valid WAV and a crash only loses what is still queued.
+class WavStreamWriter:
+    def __init__(self, path, channels, rate, sample_width=2, max_blocks=64):
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_blocks) # Bounds memory if the disk falls behind
+        self.finished = threading.Event()
+        self.frames_written = 0
+        self.error = None # What stopped the writer, if anything
+        self.file = open(path, 'wb')
+        self.wf = wave.open(self.file, 'wb')
+        self.wf.setnchannels(channels)
+        self.wf.setsampwidth(sample_width)
+        self.wf.setframerate(rate)
+        self.frame_size = channels * sample_width
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Blocks only while the queue is full
+    def write(self, data):
+        self.queue.put(bytes(data))
+
+    # Finishes writing whatever is queued, then closes the file
+    def close(self):
+        self.queue.put(None)
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    def run(self):
+        done = False
+        try:
+            while not done:
+                # Batch everything already queued into one write and one header patch
+                chunks = [self.queue.get()]
+                while True:
+                    try:
+                        chunks.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in chunks:
+                    done = True
+                    chunks = chunks[:chunks.index(None)]
+                if chunks:
+                    data = b''.join(chunks)
+                    self.wf.writeframes(data)
+                    self.file.flush()
+                    self.frames_written += len(data) // self.frame_size
+        except Exception as e: # A full disk, say
+            self.error = e
+            while not done: # Keep draining so write() and close() never block
+                done = self.queue.get() is None
+        finally:
+            for close in (self.wf.close, self.file.close): # Patching the header can fail the same way
+                try:
+                    close()
+                except OSError as e:
+                    if self.error is None:
+                        self.error = e
+            self.finished.set()
@@ -0,0 +1,40 @@
+import soundfile as sf
+from engine import AudioEngine, CHUNK, CHANNELS, RATE
+
+# Seeds typed by a user: integers when they look like one, any other text as is
+def parse_seed(text):
+    if text is None or not str(text).strip():
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return str(text).strip()
+
+# Mixes copies of the given players straight to a file, much faster than real time.
+# The container (WAV, FLAC, ...) follows the file extension and blocks are written
+# as they are mixed so memory stays flat for any duration.
+# seed - makes the random one-shot intervals reproducible, None for a random run
+# progress - optional callable given the fraction rendered so far
+# bus - send bus settings for the reverb and delay, see effects.SendBus
+# speakers - speaker azimuths for more than two channels, see AudioEngine
+def render_to_file(players, path, duration, seed=None, rate=RATE, channels=CHANNELS, chunk=CHUNK, progress=None, bus=None,
+                   speakers=None):
+    engine = AudioEngine(rate, channels, chunk, speakers)
+    engine.rng.seed(seed)
+    engine.bus.configure(bus)
+    for player in players:
+        voice = player.clone(engine)
+        voice.toggle_play() # Everything starts together, as when pressing Play
+        engine.add_voice(voice)
+    engine.playing = True
+
+    total = int(duration * rate)
+    written = 0
+    with sf.SoundFile(path, 'w', samplerate=rate, channels=channels, subtype='PCM_16') as f:
+        while written < total:
+            frames = min(chunk, total - written)
+            f.write(engine.mix(chunk)[:frames])
+            written += frames
+            if progress:
+                progress(written / total)
+    return written
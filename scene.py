@@ -0,0 +1,98 @@
+import json
+import os
+from engine import AudioPlayer, STEAL_MODES
+
+SCENE_VERSION = 1
+
+# Scene files are JSON: {"version": 1, "sounds": [{"name": ..., **AudioPlayer.settings()}], "bus": {...}}.
+# Sound paths are stored relative to the scene file when they share a drive with it.
+# bus - the engine's send bus settings, see effects.SendBus
+def save_scene(path, players, names=None, bus=None):
+    base = os.path.dirname(os.path.abspath(path))
+    sounds = []
+    for i, player in enumerate(players):
+        settings = player.settings()
+        try:
+            settings['file'] = os.path.relpath(os.path.abspath(player.filename), base)
+        except ValueError: # Different drive on Windows
+            settings['file'] = os.path.abspath(player.filename)
+        name = names[i] if names else os.path.splitext(os.path.basename(player.filename))[0]
+        sounds.append(dict(name=name, **settings))
+    with open(path, 'w') as f:
+        json.dump({'version': SCENE_VERSION, 'sounds': sounds, 'bus': bus or {}}, f, indent=2)
+
+# Reads a scene file, resolving sound paths to absolute ones. Raises ValueError on
+# anything that is not a scene.
+def load_scene(path):
+    with open(path) as f:
+        scene = json.load(f)
+    if not isinstance(scene, dict) or not isinstance(scene.get('sounds'), list):
+        raise ValueError(f"{path} is not a scene file")
+    if not isinstance(scene.setdefault('bus', {}), dict):
+        raise ValueError(f"{path} has a bus that is not an object")
+    if scene.get('version', SCENE_VERSION) > SCENE_VERSION:
+        raise ValueError(f"{path} was saved by a newer version (scene version {scene['version']})")
+    base = os.path.dirname(os.path.abspath(path))
+    for sound in scene['sounds']:
+        if not isinstance(sound, dict) or not isinstance(sound.get('file'), str):
+            raise ValueError(f"{path} has a sound without a file")
+        sound['file'] = os.path.normpath(os.path.join(base, sound['file']))
+        sound.setdefault('name', os.path.splitext(os.path.basename(sound['file']))[0])
+        try:
+            check_sound(sound)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}")
+    return scene
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+# Raises ValueError unless every setting of a scene sound has the type and shape
+# AudioPlayer.apply_settings and the GUI read it as. Values are range-checked where
+# they are used (the filter and automation classes raise ValueError themselves).
+def check_sound(sound):
+    name = sound.get('name')
+    if not isinstance(name, str):
+        raise ValueError(f"sound {sound.get('file')} has a name that is not text")
+    for key in ('volume', 'pan', 'send', 'spread'):
+        if key in sound and not is_number(sound[key]):
+            raise ValueError(f"sound {name}: {key} must be a number")
+    for key in ('muted', 'looping'):
+        if key in sound and not isinstance(sound[key], bool):
+            raise ValueError(f"sound {name}: {key} must be true or false")
+    for key in ('interval', 'trim'):
+        value = sound.get(key)
+        if value is not None and not (isinstance(value, list) and len(value) == 2 and all(map(is_number, value))):
+            raise ValueError(f"sound {name}: {key} must be null or a list of two numbers")
+    if 'polyphony' in sound and not (is_number(sound['polyphony']) and sound['polyphony'] == int(sound['polyphony'])):
+        raise ValueError(f"sound {name}: polyphony must be a whole number")
+    if 'steal' in sound and sound['steal'] not in STEAL_MODES:
+        raise ValueError(f"sound {name}: steal must be one of {', '.join(STEAL_MODES)}")
+    if sound.get('normalize') is not None and not is_number(sound['normalize']):
+        raise ValueError(f"sound {name}: normalize must be null or a loudness in LUFS")
+    sound_filter = sound.get('filter')
+    if sound_filter is not None:
+        if not isinstance(sound_filter, dict):
+            raise ValueError(f"sound {name}: filter must be null or an object")
+        for key in ('cutoff', 'order'):
+            if key in sound_filter and not is_number(sound_filter[key]):
+                raise ValueError(f"sound {name}: filter {key} must be a number")
+    automation = sound.get('automation', [])
+    if not isinstance(automation, list) or not all(isinstance(x, dict) for x in automation):
+        raise ValueError(f"sound {name}: automation must be a list of objects")
+    for modulator in automation:
+        for key, value in modulator.items():
+            if key not in ('type', 'target') and not is_number(value):
+                raise ValueError(f"sound {name}: automation {key} must be a number")
+
+# Creates a player on engine for every sound in a loaded scene
+# buffers - optional dict of file path to an already loaded PcmBuffer to share
+def build_players(scene, engine, buffers=None):
+    players = []
+    for sound in scene['sounds']:
+        extension = os.path.splitext(sound['file'])[1][1:]
+        buffer = buffers.get(sound['file']) if buffers else None
+        player = AudioPlayer(sound['file'], extension, engine, buffer)
+        player.apply_settings(sound)
+        players.append(player)
+    return players
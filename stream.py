@@ -0,0 +1,249 @@
+import os
+import queue
+import sys
+import threading
+import time
+import numpy as np
+from backends import NullBackend
+
+SINK_QUEUE_BLOCKS = 256 # Blocks a sink may fall behind, a few seconds at the usual block sizes
+CLOSE_TIMEOUT = 10.0 # Seconds close() waits for a sink to finish, a FIFO with no reader never does
+
+# Where a streamed mix goes. Each sink writes int16 blocks from a bounded queue on its own
+# thread, so a slow disk or reader never holds up mixing and memory stays flat however
+# long it runs. Subclasses provide write_data(bytes) and may override open() and close_output().
+class Sink:
+    def __init__(self, max_blocks=SINK_QUEUE_BLOCKS):
+        self.queue = queue.Queue(maxsize=max_blocks)
+        self.dropped = 0 # Blocks thrown away because the sink was behind
+        self.error = None # What stopped the sink, if anything
+        self.thread = None
+
+    def start(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+        self.thread.start()
+
+    # wait - block while the queue is full, for offline streaming. Live streaming drops
+    # the block instead, as a sound card would.
+    def write(self, block, wait=False):
+        if self.error is not None:
+            return
+        data = block.tobytes()
+        if wait:
+            self.queue.put(data)
+            return
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    # Writes whatever is queued, then closes
+    def close(self):
+        if self.thread:
+            try:
+                self.queue.put(None, timeout=CLOSE_TIMEOUT)
+                self.thread.join(CLOSE_TIMEOUT)
+            except queue.Full:
+                pass
+            self.thread = None
+
+    def run(self):
+        done = False
+        try:
+            self.open()
+            while True:
+                # Batch everything already queued into one write
+                chunks = [self.queue.get()]
+                while True:
+                    try:
+                        chunks.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                done = None in chunks
+                if done:
+                    chunks = chunks[:chunks.index(None)]
+                if chunks:
+                    self.write_data(b''.join(chunks))
+                if done:
+                    break
+        except Exception as e:
+            self.error = e
+            while not done: # Keep draining so offline writers never block
+                done = self.queue.get() is None
+        finally:
+            self.close_output()
+
+    def open(self):
+        pass
+
+    def close_output(self):
+        pass
+
+# Audio files, started afresh every rotate_seconds of audio or once a file reaches
+# rotate_bytes. The pattern is formatted with strftime when each file opens and may hold
+# {index} for the file's number in this run, added before the extension when it is missing
+# so names never repeat. keep - how many of the newest files to leave on disk, None for all.
+class RotatingFileSink(Sink):
+    def __init__(self, pattern, rotate_seconds=None, rotate_bytes=None, keep=None, max_blocks=SINK_QUEUE_BLOCKS):
+        super().__init__(max_blocks)
+        if rotate_seconds is not None and rotate_seconds <= 0 or rotate_bytes is not None and rotate_bytes <= 0:
+            raise ValueError("rotation needs a positive number of seconds or bytes")
+        if keep is not None and keep < 1:
+            raise ValueError("keep must be at least 1 file")
+        if '{index' not in pattern:
+            root, extension = os.path.splitext(pattern)
+            pattern = root + '-{index:04d}' + extension
+        self.pattern = pattern
+        self.rotate_seconds = rotate_seconds
+        self.rotate_bytes = rotate_bytes
+        self.keep = keep
+        self.index = 0
+        self.file = None
+        self.paths = [] # Files written in this run, oldest first, at most keep of them
+        self.frames = 0 # Frames in the current file
+
+    # Files open with their first frame, so a run ending on a rotation leaves no empty file
+    def next_file(self):
+        import soundfile as sf
+        path = time.strftime(self.pattern).format(index=self.index)
+        self.index += 1
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.raw = open(path, 'wb')
+        extension = os.path.splitext(path)[1][1:].upper()
+        self.file = sf.SoundFile(self.raw, 'w', samplerate=self.rate, channels=self.channels,
+                                 format=extension if extension in sf.available_formats() else 'WAV')
+        self.frames = 0
+        self.paths.append(path)
+        if self.keep is not None:
+            while len(self.paths) > self.keep:
+                try:
+                    os.remove(self.paths.pop(0))
+                except OSError:
+                    pass
+
+    def write_data(self, data):
+        samples = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels)
+        while len(samples):
+            if self.file is None:
+                self.next_file()
+            frames = len(samples)
+            if self.rotate_seconds is not None: # Cut on the exact frame
+                frames = min(frames, int(self.rotate_seconds * self.rate) - self.frames)
+            self.file.write(samples[:frames])
+            self.frames += frames
+            samples = samples[frames:]
+            if self.rotate_seconds is not None and self.frames >= int(self.rotate_seconds * self.rate) or \
+               self.rotate_bytes is not None and self.raw.tell() >= self.rotate_bytes:
+                self.close_output()
+        if self.file is not None:
+            self.file.flush() # Keeps the header current, so a crash only loses the queue
+
+    def close_output(self):
+        if self.file is not None:
+            self.file.close()
+            self.raw.close()
+            self.file = None
+
+# Raw interleaved signed 16-bit little-endian PCM to stdout ('-') or a file or FIFO, for
+# piping into an encoder or streaming server. A FIFO is opened on the sink's thread, so
+# the stream runs (dropping blocks) until a reader connects, and when the reader goes
+# away it waits for the next one. A reader closing stdout ends the sink.
+class PipeSink(Sink):
+    def __init__(self, path='-', max_blocks=SINK_QUEUE_BLOCKS):
+        super().__init__(max_blocks)
+        self.path = path
+        self.out = None
+
+    def open(self):
+        if self.path == '-':
+            self.out = sys.stdout.buffer
+        else:
+            self.out = open(self.path, 'wb')
+
+    def write_data(self, data):
+        if sys.byteorder != 'little':
+            data = np.frombuffer(data, dtype=np.int16).byteswap().tobytes()
+        try:
+            self.out.write(data)
+            self.out.flush()
+        except BrokenPipeError:
+            if self.path == '-':
+                # Nothing more can reach stdout, and flushing it again at exit would fail too
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                raise
+            self.close_output()
+            self.drain()
+            self.open() # Blocks until the next reader
+
+    # Throws away what was queued for the reader that left
+    def drain(self):
+        while True:
+            try:
+                data = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if data is None:
+                self.queue.put(None)
+                return
+
+    def close_output(self):
+        if self.out is not None and self.path != '-':
+            try:
+                self.out.close()
+            except BrokenPipeError:
+                pass
+        self.out = None
+
+# Builds a sink from a command line spec: '-' for raw PCM on stdout, 'pipe:PATH' for raw
+# PCM to a FIFO or file, anything else is an audio file pattern for RotatingFileSink
+def make_sink(spec, rotate_seconds=None, rotate_bytes=None, keep=None):
+    if spec == '-':
+        return PipeSink('-')
+    if spec.startswith('pipe:'):
+        return PipeSink(spec[len('pipe:'):])
+    return RotatingFileSink(spec, rotate_seconds, rotate_bytes, keep)
+
+# Mixes on the engine clock and hands every block to each sink instead of a sound card.
+# Paced in real time like the null backend when config.realtime is set, otherwise as fast
+# as the slowest sink takes the blocks.
+#   frames - stop after this many frames, None to run until closed
+class StreamBackend(NullBackend):
+    def __init__(self, config, sinks, frames=None):
+        super().__init__(config)
+        self.sinks = list(sinks)
+        self.frames = frames
+        self.written = 0
+        self.finished = threading.Event()
+
+    def open_output(self, engine):
+        for sink in self.sinks:
+            sink.start(engine.rate, engine.channels)
+        super().open_output(engine)
+
+    def write(self, block):
+        if self.frames is not None:
+            block = block[:self.frames - self.written]
+        for sink in self.sinks:
+            sink.write(block, wait=not self.config.realtime)
+        self.written += len(block)
+        if self.frames is not None and self.written >= self.frames:
+            self.running = False
+            self.finished.set()
+
+    def close(self):
+        super().close()
+        for sink in self.sinks:
+            sink.close()
+        self.finished.set()
+
+    @property
+    def dropped(self):
+        return sum(sink.dropped for sink in self.sinks)
+
+    @property
+    def errors(self):
+        return [sink.error for sink in self.sinks if sink.error is not None]